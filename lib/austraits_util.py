@@ -1,4 +1,3 @@
-from IPython.display import display, Markdown
 def extract_reflabel(x,refid):
     authors=list()
     year=x.entries[refid].fields['year']
@@ -25,12 +24,15 @@ def extract_refinfo(x,refid):
             refcitation = refcitation + " " + x.entries[refid].fields[f]
     return refcitation 
 
+# `taxlist` can be a data frame with the BioNet names, or a `TaxonNameIndex` from module `firevegtaxa` to match names after normalisation and with fuzzy matching
 def match_spcode(row, taxlist):
     spname=row['taxon_name']
     altname=row['original_name']
     result={'species':spname}
     if altname!=spname:
         result['original_notes']=['original_name:',altname]
+    if hasattr(taxlist, 'match'):
+        return match_spcode_index(result, spname, altname, taxlist)
     spp_info = taxlist[taxlist['scientificName'] == spname] 
     spcode=None
     if len(spp_info)==1 and spp_info.speciesCode_Synonym is not None:
@@ -45,7 +47,26 @@ def match_spcode(row, taxlist):
  
     return result
 
-def create_record(row, refs, vocab, taxlist):
+def match_spcode_index(result, spname, altname, index):
+    match=index.match(spname)
+    if (match is None or 'species_code' not in match) and spname != altname:
+        match=index.match(altname)
+        if match is not None and 'species_code' in match:
+            result['original_notes'].append('original name used to match with BioNET names')
+    if match is not None and 'species_code' in match:
+        result['species_code']=match['species_code']
+        if match['method'] == 'fuzzy':
+            result.setdefault('original_notes', list()).append(
+                'name matched to %s with score %s' % (match['matched_name'], match['score']))
+    return result
+
+# Label of a main source in the record notes, e.g. 'Austraits (v6.0.0)' for 'austraits-6.0.0'
+def source_label(main_source):
+    if main_source.startswith('austraits-'):
+        return 'Austraits (v%s)' % main_source[len('austraits-'):]
+    return main_source
+
+def create_record(row, refs, vocab, taxlist, main_source='austraits-6.0.0'):
     refid=row['dataset_id']
     if refid in list(refs.entries.keys()):
         reflabel = extract_reflabel(refs,refid)
@@ -54,7 +75,7 @@ def create_record(row, refs, vocab, taxlist):
     
     transvalue=vocab.get(row['value'], None)
     
-    record={'main_source': 'austraits-6.0.0',
+    record={'main_source': main_source,
             'additional_notes': ['Values reclassified by JRFP',
                                 'Automatic extraction with python script'],
             'raw_value': [row['trait_name'],row['value'],row['value_type']],
@@ -71,7 +92,7 @@ def create_record(row, refs, vocab, taxlist):
             else:
                 srclabel=srcid
             record['original_sources'].append(srclabel)
-        record['additional_notes'].append('Austraits (v6.0.0) record with source_id as well as dataset_id')
+        record['additional_notes'].append('%s record with source_id as well as dataset_id' % source_label(main_source))
     if reflabel=='NSWFRD_2014':
         record['weight'] = 0
         record['weight_notes'] = ["python-script import","default of 0 for redundant records"]
@@ -85,7 +106,13 @@ def create_record(row, refs, vocab, taxlist):
         record['original_notes'].append(str(row['location_id']))
     return(record)
 
+# Records for one chunk of rows of a data frame, see `import_trait`
+def chunk_records(rows, refs, vocab, taxlist, main_source='austraits-6.0.0'):
+    return [create_record(row, refs, vocab, taxlist, main_source) for row in rows.to_dict(orient='records')]
+
 def trait_summary(definitions, traits, trait_name):
+    # display functions are only needed in notebooks
+    from IPython.display import display, Markdown
     description = definitions[trait_name]['description']
     allowed_values = definitions[trait_name]['allowed_values_levels']
     ss = (traits['trait_name']==trait_name)
@@ -95,4 +122,93 @@ def trait_summary(definitions, traits, trait_name):
         display(Markdown("*{}*:\n{}\n".format(k,v)))
     display(Markdown("Frequency of values in this version of Austraits:\n"))
     res = traits[ss]['value'].value_counts()
-    print(res)
\ No newline at end of file
+    print(res)
+
+## Parallel import of AusTraits records
+# Each trait in `fireveg_defs` (see `vocabularies.austraits_definitions`) is processed in a separate process with its own database connection. The references of all traits are collected and loaded once before the traits are imported. Missing values in the `traits` data frame should be filled with "nan", as in the notebook.
+
+# Extract the list of reference ids (dataset_id and source_id) from a data frame of trait records
+def extract_refids(df):
+    refids=list(df['dataset_id'].unique())
+    for source_ids in df.loc[df['source_id'] != "nan", 'source_id'].unique():
+        refids.extend(x.strip() for x in source_ids.split(','))
+    return list(dict.fromkeys(refids))
+
+def reference_records(refids, refs):
+    refrecords=list()
+    for refid in refids:
+        if refid in refs.entries.keys():
+            refrecords.append({'ref_code': extract_reflabel(refs,refid),
+                               'alt_code': refid,
+                               'ref_cite': extract_refinfo(refs, refid)})
+    return refrecords
+
+# Import the records of one trait, this runs in a worker process
+# Each chunk is loaded with a checkpoint (module `checkpoints`), with `resume=True` chunks loaded in a previous run are skipped and failed chunks are quarantined. Records already in the trait table, from this or an earlier import, are found by content hash (module `firevegdedup`) and not inserted again.
+def import_trait(params, trait, austvals, frames, refs, taxlist, main_source='austraits-6.0.0', chunk_size=500, resume=True):
+    import time
+    import functools
+    import psycopg2
+    from lib.firevegdb import dbquery
+    from collections import Counter
+    from lib.checkpoints import checkpointed_upsert
+    from lib.vocabularies import as_vocabulary
+    start=time.perf_counter()
+    summary={'trait': trait, 'austrait_names': [vals['austrait_name'] for vals in austvals],
+             'source_rows': sum(df.shape[0] for df in frames), 'records': 0, 'updated_rows': 0, 'quarantined': 0, 'skipped': False,
+             'unmapped': Counter()}
+    db_conn = psycopg2.connect(**params)
+    try:
+        res = dbquery("SELECT count(*) FROM litrev.{} WHERE main_source = '{}';".format(trait, main_source), params, useconn=db_conn)
+        nrecords=list(res[0])[0]
+        if int(nrecords)>=summary['source_rows']:
+            summary['skipped']=True
+        else:
+            for vals, df in zip(austvals, frames):
+                vocab=as_vocabulary(vals['matched_values'])
+                summary['unmapped'].update(vocab.unmapped(df['value']))
+                # records are created by checkpointed_upsert, an error in one chunk quarantines that chunk only
+                chunks=((i, functools.partial(chunk_records, df[i:i+chunk_size], refs, vocab, taxlist, main_source))
+                        for i in range(0, df.shape[0], chunk_size))
+                res = checkpointed_upsert(params, main_source, "%s:%s" % (trait, vals['austrait_name']),
+                                          "litrev."+trait, chunks, keycol=['ref_code',], idx=None,
+                                          resume=resume, useconn=db_conn, dedup=True)
+                summary['records'] = summary['records'] + df.shape[0]
+                summary['updated_rows'] = summary['updated_rows'] + res['updated_rows']
+                summary['quarantined'] = summary['quarantined'] + res['quarantined']
+    finally:
+        db_conn.close()
+    summary['seconds']=round(time.perf_counter()-start, 1)
+    return summary
+
+def import_austraits(params, fireveg_defs, traits, refs, taxlist, workers=None, main_source='austraits-6.0.0', chunk_size=500, resume=True):
+    from concurrent.futures import ProcessPoolExecutor
+    from lib.firevegdb import bulk_upsert
+    tasks=dict()
+    refids=list()
+    for trait, austvals in fireveg_defs.items():
+        frames=[traits[traits['trait_name']==vals['austrait_name']] for vals in austvals]
+        tasks[trait]=(austvals, frames)
+        for df in frames:
+            refids.extend(extract_refids(df))
+    refrecords = reference_records(list(dict.fromkeys(refids)), refs)
+    bulk_upsert(params, table='litrev.ref_list', records=refrecords,
+                keycol=['ref_code',], idx=None, execute=True)
+
+    summaries=list()
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures=[executor.submit(import_trait, params, trait, austvals, frames, refs, taxlist, main_source, chunk_size, resume)
+                 for trait, (austvals, frames) in tasks.items()]
+        for future in futures:
+            summary=future.result()
+            if summary['skipped']:
+                print("Trait %s: already %s records in the database, skipped." % (summary['trait'], summary['source_rows']))
+            else:
+                print("Trait %s (%s): %s records, %s rows updated, %s chunks quarantined in %s s" % (
+                    summary['trait'], ', '.join(summary['austrait_names']),
+                    summary['records'], summary['updated_rows'], summary['quarantined'], summary['seconds']))
+                if len(summary['unmapped'])>0:
+                    print("  %s distinct values without a match, most frequent: %s" % (
+                        len(summary['unmapped']), summary['unmapped'].most_common(5)))
+            summaries.append(summary)
+    return summaries
@@ -0,0 +1,127 @@
+import io
+import json
+import urllib.parse
+import urllib.request
+import psycopg2
+
+odata_url = 'https://data.bionet.nsw.gov.au/biosvcapp/odata/SpeciesNames'
+
+## Read the SpeciesNames feed one page at a time
+# Pages are requested with `$top`/`$skip` and filtered by kingdom on the server. A `@odata.nextLink` in the response is followed when present. Otherwise the next page starts after the rows received so far, and reading stops when a page comes back empty, so a server that returns fewer rows than `$top` is still read to the end. With `@odata.count` in the response, reading stops as soon as all rows have been received. Use `url` to read from a different service, e.g. a local server with recorded pages.
+def iter_species_pages(url=odata_url, page_size=5000, kingdom='Plantae', timeout=300):
+    skip = 0
+    total = None
+    query = {'$top': page_size, '$skip': skip, '$count': 'true'}
+    if kingdom is not None:
+        query['$filter'] = "kingdom eq '%s'" % kingdom
+    next_url = url + '?' + urllib.parse.urlencode(query)
+    while next_url is not None:
+        with urllib.request.urlopen(next_url, timeout=timeout) as response:
+            if response.getcode() != 200:
+                raise Exception('Error receiving data from {0}: {1}'.format(next_url, response.getcode()))
+            page = json.load(response)
+        values = page.get('value', [])
+        if '@odata.count' in page:
+            total = int(page['@odata.count'])
+        skip = skip + len(values)
+        if len(values) > 0:
+            yield values
+        if '@odata.nextLink' in page:
+            next_url = urllib.parse.urljoin(next_url, page['@odata.nextLink'])
+        elif len(values) == 0 or (total is not None and skip >= total):
+            next_url = None
+        else:
+            query['$skip'] = skip
+            next_url = url + '?' + urllib.parse.urlencode(query)
+
+def _column_type(value):
+    if isinstance(value, bool):
+        return 'boolean'
+    if isinstance(value, int):
+        return 'bigint'
+    if isinstance(value, float):
+        return 'double precision'
+    return 'text'
+
+# One field in the CSV format of COPY: None is written as an unquoted empty field (NULL) and strings are always quoted, so that empty strings and NULL values are kept apart
+def _csv_field(value):
+    if value is None:
+        return ''
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+    if isinstance(value, (int, float)):
+        return repr(value)
+    if isinstance(value, (dict, list)):
+        value = json.dumps(value)
+    return '"%s"' % str(value).replace('"', '""')
+
+# Copy one page of records into the staging table
+def _copy_page(cur, stage, columns, values):
+    buffer = io.StringIO()
+    for record in values:
+        buffer.write(','.join(_csv_field(record.get(col)) for col in columns))
+        buffer.write('\n')
+    buffer.seek(0)
+    cols = ','.join('"%s"' % col for col in columns)
+    cur.copy_expert('COPY %s (%s) FROM STDIN WITH (FORMAT csv)' % (stage, cols), buffer)
+
+## Load species names into table `species.bionet`
+# Each page is streamed with COPY into a temporary staging table with the same structure as the target table, and only new or changed rows are then inserted or updated by `speciesID`. The table and its indexes are created on the first run and kept afterwards.
+def update_bionet_species(params, pages, table='species.bionet', keycol='speciesID', execute=False, useconn=None):
+    if useconn is None:
+        # connect to the PostgreSQL server
+        print('Connecting to the PostgreSQL database...')
+        conn = psycopg2.connect(**params)
+    else:
+        conn = useconn
+    cur = conn.cursor()
+    schema, tablename = table.split('.')
+    stage = 'bionet_stage'
+    columns = None
+    read_rows = 0
+    updated_rows = 0
+
+    for values in pages:
+        if columns is None:
+            cur.execute("SELECT column_name FROM information_schema.columns WHERE table_schema=%s AND table_name=%s ORDER BY ordinal_position",
+                        (schema, tablename))
+            existing = [row[0] for row in cur.fetchall()]
+            if len(existing) == 0:
+                coldefs = ','.join('"%s" %s' % (k, _column_type(v)) for k, v in values[0].items())
+                qry = 'CREATE TABLE %s (%s, PRIMARY KEY ("%s")); CREATE INDEX scientific_idx ON %s ("scientificName");' % (
+                    table, coldefs, keycol, table)
+                if execute:
+                    cur.execute(qry)
+                else:
+                    print(qry)
+                columns = list(values[0].keys())
+            else:
+                columns = [col for col in values[0].keys() if col in existing]
+                ignored = [col for col in values[0].keys() if col not in existing]
+                if len(ignored) > 0:
+                    print("columns not in %s are ignored: %s" % (table, ', '.join(ignored)))
+            if execute:
+                cur.execute("CREATE TEMP TABLE %s (LIKE %s) ON COMMIT DROP" % (stage, table))
+        if execute:
+            _copy_page(cur, stage, columns, values)
+        read_rows = read_rows + len(values)
+
+    if columns is not None:
+        cols = ','.join('"%s"' % col for col in columns)
+        upd = ','.join('"{col}"=EXCLUDED."{col}"'.format(col=col) for col in columns if col != keycol)
+        changed = ' OR '.join('t."{col}" IS DISTINCT FROM EXCLUDED."{col}"'.format(col=col) for col in columns if col != keycol)
+        qry = 'INSERT INTO %s AS t (%s) SELECT DISTINCT ON ("%s") %s FROM %s ON CONFLICT ("%s") DO UPDATE SET %s WHERE %s' % (
+            table, cols, keycol, cols, stage, keycol, upd, changed)
+        if execute:
+            cur.execute(qry)
+            updated_rows = cur.rowcount
+        else:
+            print(qry)
+
+    conn.commit()
+    cur.close()
+    print("%s rows read, %s rows inserted or updated" % (read_rows, updated_rows))
+    if useconn is None and conn is not None:
+        conn.close()
+        print('Database connection closed.')
+    return read_rows, updated_rows
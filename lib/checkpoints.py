@@ -0,0 +1,144 @@
+import hashlib
+import json
+from itertools import islice
+import psycopg2
+from psycopg2.extras import Json
+from lib.firevegdb import bulk_upsert
+
+## Checkpoints for long running imports
+# Imports are split in chunks of records. When a chunk is committed, a progress marker (source, trait, chunk offset and content hash) is written in the same transaction, so that the marker exists if and only if the records were loaded. Chunks that fail are rolled back and stored in a quarantine table with the error message. With `resume=True`, chunks with a marker and the same content hash are skipped, so a failed import can continue from the last good chunk.
+
+checkpoint_table = 'public.import_checkpoints'
+quarantine_table = 'public.import_quarantine'
+
+def create_checkpoint_tables(cur):
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS %s (
+        source text NOT NULL,
+        trait text NOT NULL,
+        chunk_offset integer NOT NULL,
+        content_hash text NOT NULL,
+        nrecords integer,
+        updated_rows integer,
+        loaded_at timestamp DEFAULT now(),
+        PRIMARY KEY (source, trait, chunk_offset));
+    CREATE TABLE IF NOT EXISTS %s (
+        source text NOT NULL,
+        trait text NOT NULL,
+        chunk_offset integer NOT NULL,
+        content_hash text NOT NULL,
+        error text,
+        records jsonb,
+        failed_at timestamp DEFAULT now(),
+        PRIMARY KEY (source, trait, chunk_offset));
+    """ % (checkpoint_table, quarantine_table))
+
+# Split an iterable of records into (offset, list of records) chunks
+def chunked(records, size=500):
+    iterator = iter(records)
+    offset = 0
+    while True:
+        chunk = list(islice(iterator, size))
+        if len(chunk) == 0:
+            return
+        yield offset, chunk
+        offset = offset + len(chunk)
+
+# Content hash of a chunk of records, independent of the order of keys in each record
+def chunk_hash(records):
+    content = json.dumps(list(records), sort_keys=True, default=str)
+    return hashlib.sha1(content.encode('utf-8')).hexdigest()
+
+def _quarantine(cur, source, trait, offset, content_hash, error, records):
+    cur.execute("INSERT INTO " + quarantine_table + " (source, trait, chunk_offset, content_hash, error, records) VALUES (%s,%s,%s,%s,%s,%s) " +
+                "ON CONFLICT (source, trait, chunk_offset) DO UPDATE SET content_hash=EXCLUDED.content_hash, error=EXCLUDED.error, records=EXCLUDED.records, failed_at=now()",
+                (source, trait, offset, content_hash, error, None if records is None else Json(records, dumps=lambda x: json.dumps(x, default=str))))
+
+def completed_chunks(cur, source, trait):
+    cur.execute("SELECT chunk_offset, content_hash FROM " + checkpoint_table + " WHERE source=%s AND trait=%s",
+                (source, trait))
+    return dict(cur.fetchall())
+
+## Load chunks of records with checkpoints
+# `chunks` is an iterable of (offset, records), e.g. from `chunked`, where records is a list or a function without arguments that returns the list. Functions are called for one chunk at a time, and a chunk whose records can not be created is quarantined with the error instead of stopping the import. With `dedup=True` the records are loaded with `firevegdedup.dedup_upsert`, rows of the table without content hash are hashed once before the first chunk and records already in the table are skipped. Returns a summary with the number of chunks loaded, skipped and quarantined, and the number of rows updated.
+def checkpointed_upsert(params, source, trait, table, chunks, keycol, idx, resume=True, useconn=None, page_size=500, dedup=False):
+    if useconn is None:
+        # connect to the PostgreSQL server
+        print('Connecting to the PostgreSQL database...')
+        conn = psycopg2.connect(**params)
+    else:
+        conn = useconn
+    cur = conn.cursor()
+    create_checkpoint_tables(cur)
+    conn.commit()
+    done = completed_chunks(cur, source, trait) if resume else dict()
+    if dedup:
+        from lib.firevegdedup import backfill_hashes, dedup_upsert
+        backfill_hashes(params, table, execute=True, useconn=conn)
+    summary = {'loaded': 0, 'skipped': 0, 'quarantined': 0, 'updated_rows': 0}
+
+    for offset, records in chunks:
+        if callable(records):
+            try:
+                records = records()
+            except Exception as error:
+                message = "could not create records: %s: %s" % (type(error).__name__, error)
+                conn.rollback()
+                print("chunk at offset %s of %s/%s quarantined: %s" % (offset, source, trait, message))
+                _quarantine(cur, source, trait, offset, '', message, None)
+                conn.commit()
+                summary['quarantined'] = summary['quarantined'] + 1
+                continue
+        content_hash = chunk_hash(records)
+        if done.get(offset) == content_hash:
+            summary['skipped'] = summary['skipped'] + 1
+            continue
+        try:
+            cur.execute("INSERT INTO " + checkpoint_table + " (source, trait, chunk_offset, content_hash, nrecords) VALUES (%s,%s,%s,%s,%s) " +
+                        "ON CONFLICT (source, trait, chunk_offset) DO UPDATE SET content_hash=EXCLUDED.content_hash, nrecords=EXCLUDED.nrecords, loaded_at=now()",
+                        (source, trait, offset, content_hash, len(records)))
+            cur.execute("DELETE FROM " + quarantine_table + " WHERE source=%s AND trait=%s AND chunk_offset=%s",
+                        (source, trait, offset))
+            # bulk_upsert commits the records together with the marker
+            if dedup:
+                updated_rows = dedup_upsert(params, table, records, execute=True, useconn=conn, page_size=page_size, backfill=False)['updated_rows']
+            else:
+                updated_rows = bulk_upsert(params, table, records, keycol, idx, execute=True, useconn=conn, page_size=page_size)
+        except psycopg2.Error as error:
+            conn.rollback()
+            print("chunk at offset %s of %s/%s quarantined: %s" % (offset, source, trait, str(error).strip()))
+            _quarantine(cur, source, trait, offset, content_hash, str(error), records)
+            conn.commit()
+            summary['quarantined'] = summary['quarantined'] + 1
+            continue
+        cur.execute("UPDATE " + checkpoint_table + " SET updated_rows=%s WHERE source=%s AND trait=%s AND chunk_offset=%s",
+                    (updated_rows, source, trait, offset))
+        conn.commit()
+        summary['loaded'] = summary['loaded'] + 1
+        summary['updated_rows'] = summary['updated_rows'] + updated_rows
+
+    cur.close()
+    print("%s/%s: %s chunks loaded, %s skipped, %s quarantined" % (
+        source, trait, summary['loaded'], summary['skipped'], summary['quarantined']))
+    if useconn is None and conn is not None:
+        conn.close()
+        print('Database connection closed.')
+    return summary
+
+# Chunks that failed in previous runs, with their error messages
+def quarantined_chunks(params, source=None, useconn=None):
+    if useconn is None:
+        conn = psycopg2.connect(**params)
+    else:
+        conn = useconn
+    cur = conn.cursor()
+    qry = "SELECT source, trait, chunk_offset, error, failed_at FROM " + quarantine_table
+    if source is not None:
+        cur.execute(qry + " WHERE source=%s ORDER BY trait, chunk_offset", (source,))
+    else:
+        cur.execute(qry + " ORDER BY source, trait, chunk_offset")
+    res = cur.fetchall()
+    cur.close()
+    if useconn is None and conn is not None:
+        conn.close()
+    return res
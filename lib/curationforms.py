@@ -0,0 +1,375 @@
+import os
+import re
+import warnings
+from pathlib import Path
+from itertools import zip_longest
+import psycopg2
+from openpyxl import Workbook
+from openpyxl.cell import WriteOnlyCell
+from openpyxl.formatting import Rule
+from openpyxl.styles import Alignment, PatternFill
+from openpyxl.styles.differential import DifferentialStyle
+from openpyxl.utils import get_column_letter
+from openpyxl.workbook.defined_name import DefinedName
+from openpyxl.worksheet.datavalidation import DataValidation
+from openpyxl.worksheet.filters import AutoFilter
+from openpyxl.worksheet.table import Table, TableColumn, TableStyleInfo
+from lib.firevegcache import load_metadata
+
+## Workbooks for manual data entry and curation
+# Forms are written with openpyxl in write-only mode, so rows are streamed to the file and the memory use does not grow with the number of pre-filled rows. The lists used by the data validations (trait codes and the valid values and methods of each trait) are written once to a hidden `Lookups` sheet and referenced through defined names (`trait_codes`, `lookup_<trait>` and `method_<trait>`); traits that share a vocabulary share the same column. The reference codes are taken from the `Code` column of the `References` table through the defined name `ref_codes`, so references added by contributors to that table appear in the drop-down list. Database content is read once with `load_form_data` and `generate_forms` writes one workbook per trait or per contributor in parallel processes.
+
+cent_align=Alignment(horizontal='center', vertical='center', wrap_text=False)
+wrap_align=Alignment(horizontal='left', vertical='top', wrap_text=True)
+
+sheet_colors = {"instructions": "1072BA" , "entry": "10BA72", "default":"505050"}
+
+def _table_style(name, first_column=True, row_stripes=False):
+    return TableStyleInfo(name=name, showFirstColumn=first_column, showLastColumn=False,
+                          showRowStripes=row_stripes, showColumnStripes=False)
+
+table_style={"Instructions": _table_style("TableStyleMedium9", row_stripes=True),
+             "Contributor": _table_style("TableStyleMedium18"),
+             "Lists": _table_style("TableStyleMedium14"),
+             "Info": _table_style("TableStyleMedium14"),
+             "Vocabularies": _table_style("TableStyleMedium14"),
+             "Entry": _table_style("TableStyleMedium18", first_column=False)}
+
+instructions = [
+"""
+Fill in your name and affilation in the "Contributor" tab, so that we can keep track of your contributions. Optionally fill in contact information for queries regarding your contribution.
+""",
+"""
+Go to sheet "Data Entry" and fill one (or more) record(s) for each combination of reference + species + trait. Use "Insert > Table Rows Above/Below" to ensure new records have same format and validation options.
+""",
+"""
+For each record, select references (main source and original sources columns) from the drop down list. If reference is not found, go to list of reference and add it to the table (use "Insert > Table Rows Above/Below" to add record to the list of references)
+""",
+"""
+For each record, type in species name as given by main source in "original_species_name" column. A lookup function will look for a match in the species list and populate columns species_code and species_name, but this can be overridden with a manual entry if needed. Rows that are already filled with a species and trait only need the references and values.
+""",
+"""
+Select a trait from the drop down menu. A lookup function will look at the trait description table and populate columns for trait name and trait type (categorical or numerical). The choice will determine the list of values for the "norm_value" column
+""",
+"""
+Add raw value as given by original source, might include values, units and short explanatory text about observation or measurement
+""",
+"""
+For numeric trait values (e.g. age in years) we use a triplet of integer values (columns best, lower and upper) to describe a fuzzy number. Fill out any needed numbers and leave other columns blank. If in doubt leave all columns blank. Examples a raw value of "5 (3-7)" would be best:5, lower:3 upper:7; a value of ">5" would be lower:5, best:blank, upper:blank; etc. This column is colored red if the selected trait is not numerical.
+
+For categorical variables, use values from drop-down list. The list will update when a categorical trait is selected and will be colored red if the selected trait is not categorical. If raw value does not match any of the options, leave blank. Values not in the dropdown list will not be imported in the database, but you can add a comment in the "notes" column.
+""",
+"""
+Fill method of estimation from drop down list.
+""",
+"""
+Add any notes, observations or comments in column "notes". Please avoid using colors or any other formatting, nor add comment on particular cells, rather write all comments as text in the "notes" column.
+"""]
+
+links = [("#Contributor!A1","Go to 'Contributor' table"),
+         ("#'Data entry'!A1","Go to 'Data Entry' table"),
+         ("#'References'!A1","Go to 'References' table"),
+         ("#'Species list'!A1","Go to 'Species list' table"),
+         ("#'Trait description'!A1","Go to 'Trait description' table"),
+         None,
+         ("#'Vocabularies'!A1","Go to 'Vocabularies' table"),
+         None,None]
+
+contributor_fields = [('Name', " Your name "), ('Affiliation', " Your institution "), ('Contact', " e-mail or phone ")]
+
+entry_header = ["Main source", "Original sources", "Original species name", "Species code", "Species name",
+                "Trait code", "Trait name", "Trait type", "Raw value", "Norm value",
+                "Best", "Lower", "Upper", "Method of estimation", "Notes"]
+
+trait_header = ["Trait Code", "Trait Name", "Description", "Type", "Life stage", "Life history process", "Priority"]
+
+## Read the content shared by all forms
+# Species list, references, trait information and the labels and descriptions of the vocabularies used by the traits. The result only has lists, tuples and dictionaries, so it can be sent once to each worker process.
+def load_form_data(params, useconn=None):
+    if useconn is None:
+        # connect to the PostgreSQL server
+        print('Connecting to the PostgreSQL database...')
+        conn = psycopg2.connect(**params)
+    else:
+        conn = useconn
+    cur = conn.cursor()
+    cur.execute('SELECT "scientificName","speciesCode_Synonym" FROM species.bionet ORDER BY "scientificName"')
+    species = [tuple(row) for row in cur.fetchall()]
+    cur.execute("SELECT ref_code,ref_cite FROM litrev.ref_list ORDER BY ref_code")
+    references = [tuple(row) for row in cur.fetchall()]
+    cur.close()
+    metadata = load_metadata(params, useconn=conn)
+    if useconn is None and conn is not None:
+        conn.close()
+        print('Database connection closed.')
+    traits = [metadata['trait_info'][code] for code in sorted(metadata['trait_info'])]
+    vocabularies = dict()
+    for trait in traits:
+        for typname in (trait['category_vocabulary'], trait['method_vocabulary']):
+            if typname is None or typname in vocabularies:
+                continue
+            descriptions = metadata['vocabulary_descriptions'].get(typname)
+            if not isinstance(descriptions, dict):
+                descriptions = dict()
+            vocabularies[typname] = [(label, descriptions.get(label)) for label in metadata['vocabulary_labels'].get(typname, ())]
+    return {'species': species, 'references': references, 'traits': traits, 'vocabularies': vocabularies}
+
+# In write-only mode the table columns are not read from the sheet, so they are given with the header
+def _add_table(ws, name, header, first_row, last_row, style):
+    ref = "A{}:{}{}".format(first_row, get_column_letter(len(header)), last_row)
+    tab = Table(displayName=name, ref=ref)
+    tab.tableColumns = [TableColumn(id=k, name=h) for k, h in enumerate(header, 1)]
+    tab.autoFilter = AutoFilter(ref=ref)
+    tab.tableStyleInfo = table_style[style]
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        ws.add_table(tab)
+
+def _create_sheet(wb, title, widths, color="default", state='visible'):
+    ws = wb.create_sheet(title)
+    # dimensions and properties have to be set before the first row is written
+    for col, width in widths.items():
+        ws.column_dimensions[col].width = width
+    ws.sheet_properties.tabColor = sheet_colors[color]
+    ws.sheet_state = state
+    return ws
+
+def _cell(ws, value, alignment=None):
+    cell = WriteOnlyCell(ws, value=value)
+    if alignment is not None:
+        cell.alignment = alignment
+    return cell
+
+def _write_instructions(wb):
+    ws = _create_sheet(wb, "Instructions", {"B": 90, "C": 40}, "instructions")
+    ws.append(["Step", "Instructions", "Links"])
+    for k, text in enumerate(instructions):
+        row = [_cell(ws, k+1, cent_align), _cell(ws, text, wrap_align)]
+        if links[k] is not None:
+            cell = _cell(ws, links[k][1])
+            cell.hyperlink = links[k][0]
+            cell.style = "Hyperlink"
+            row.append(cell)
+        ws.append(row)
+    _add_table(ws, "Instructions", ["Step", "Instructions", "Links"], 1, len(instructions)+1, "Instructions")
+
+def _write_contributor(wb, contributor=None):
+    ws = _create_sheet(wb, "Contributor", {"A": 30, "B": 60}, "entry")
+    ws.append(["Field", "Your response"])
+    for field, placeholder in contributor_fields:
+        ws.append([field, (contributor or {}).get(field, placeholder)])
+    _add_table(ws, "Contributor", ["Field", "Your response"], 1, len(contributor_fields)+1, "Contributor")
+
+## Columns of the hidden lookup sheet
+# One column for trait codes and one per vocabulary, returns the columns and the defined names pointing to them
+def _lookup_columns(data):
+    columns = [("trait_codes", [trait['code'] for trait in data['traits']])]
+    position = dict()
+    for typname, labels in data['vocabularies'].items():
+        if len(labels) > 0:
+            position[typname] = len(columns)
+            columns.append((typname, [label for label, description in labels]))
+    names = {"trait_codes": 0}
+    for trait in data['traits']:
+        for prefix, typname in (("lookup", trait['category_vocabulary']), ("method", trait['method_vocabulary'])):
+            if typname in position:
+                names["%s_%s" % (prefix, trait['code'])] = position[typname]
+    return columns, names
+
+def _write_lookups(wb, data):
+    ws = _create_sheet(wb, "Lookups", {}, state='hidden')
+    columns, names = _lookup_columns(data)
+    ws.append([header for header, values in columns])
+    for row in zip_longest(*[values for header, values in columns]):
+        ws.append(row)
+    for name, k in names.items():
+        col = get_column_letter(k+1)
+        nvalues = max(len(columns[k][1]), 1)
+        wb.defined_names.add(DefinedName(name, attr_text="Lookups!${0}$2:${0}${1}".format(col, nvalues+1)))
+
+def _write_species(wb, data):
+    ws = _create_sheet(wb, "Species list", {"A": 90})
+    ws.append(["Scientific Name", "Code"])
+    for row in data['species']:
+        ws.append(row)
+    _add_table(ws, "SpeciesList", ["Scientific Name", "Code"], 1, max(len(data['species']), 1)+1, "Lists")
+
+def _write_references(wb, data):
+    ws = _create_sheet(wb, "References", {"A": 30, "B": 60})
+    ws.append(["Code", "Full reference"])
+    for code, cite in data['references']:
+        ws.append([code, _cell(ws, cite, wrap_align)])
+    _add_table(ws, "References", ["Code", "Full reference"], 1, max(len(data['references']), 1)+1, "Lists")
+    # structured reference, the list grows with the table when contributors add references
+    wb.defined_names.add(DefinedName("ref_codes", attr_text="References[Code]"))
+
+def _write_traits(wb, data):
+    ws = _create_sheet(wb, "Trait description", {"A": 12, "B": 30, "C": 70})
+    ws.append(trait_header)
+    for trait in data['traits']:
+        ws.append([trait['code'], trait['name'], _cell(ws, trait['description'], wrap_align), trait['value_type'],
+                   trait['life_stage'], trait['life_history_process'], trait['priority']])
+    _add_table(ws, "TraitInformation", trait_header, 1, max(len(data['traits']), 1)+1, "Info")
+
+# Valid values and descriptions, one table per vocabulary listing the traits that use it
+def _write_vocabularies(wb, data):
+    ws = _create_sheet(wb, "Vocabularies", {"A": 30, "B": 60})
+    used_by = dict()
+    for trait in data['traits']:
+        if trait['category_vocabulary'] is not None:
+            used_by.setdefault(trait['category_vocabulary'], list()).append(trait['code'])
+    k = 1
+    for typname, codes in used_by.items():
+        labels = data['vocabularies'].get(typname, [])
+        if len(labels) == 0:
+            continue
+        ws.append(["Lookup table for trait %s" % ", ".join(codes)])
+        ws.append(["Valid values", "Description"])
+        for label, description in labels:
+            ws.append([label, _cell(ws, description, wrap_align)])
+        _add_table(ws, "vocabulary_%s" % typname, ["Valid values", "Description"], k+1, k+1+len(labels), "Vocabularies")
+        ws.append([])
+        k = k + len(labels) + 3
+
+def _entry_validations(last_row):
+    dv_ref = DataValidation(type="list", formula1="=ref_codes", allow_blank=True)
+    dv_ref.error ='Your entry is not in the list'
+    dv_ref.errorTitle = 'Invalid Entry'
+    dv_ref.prompt = 'Please select from the list of references'
+    dv_ref.promptTitle = 'List Selection'
+    dv_ref.add("A2:B{}".format(last_row))
+
+    dv_trait = DataValidation(type="list", formula1="=trait_codes")
+    dv_trait.error ='Your entry is not in the list'
+    dv_trait.errorTitle = 'Invalid Entry'
+    dv_trait.add("F2:F{}".format(last_row))
+
+    dv_vvalue = DataValidation(type="list", formula1='=INDIRECT("lookup_"&$F2)', allow_blank=True)
+    dv_vvalue.prompt = """For categorical traits, please select trait first and then select one value from the dropdown list, otherwise leave blank.
+For quantitative traits, leave blank and fill Best/Lower/Upper columns."""
+    dv_vvalue.promptTitle = 'Accepted values for trait'
+    dv_vvalue.add("J2:J{}".format(last_row))
+
+    dv_fuzzy = DataValidation(type="decimal", operator="greaterThanOrEqual", formula1=0, allow_blank=True)
+    dv_fuzzy.add("K2:M{}".format(last_row))
+
+    dv_method = DataValidation(type="list", formula1='=INDIRECT("method_"&$F2)', allow_blank=True)
+    dv_method.add("N2:N{}".format(last_row))
+    return [dv_ref, dv_trait, dv_vvalue, dv_fuzzy, dv_method]
+
+def _entry_formatting(ws, last_row):
+    dxf = DifferentialStyle(fill=PatternFill(bgColor="FFC7CE"))
+    r = Rule(type="expression", dxf=dxf, stopIfTrue=True)
+    r.formula = ['$H2="categorical"']
+    ws.conditional_formatting.add("K2:M{}".format(last_row), r)
+    r2 = Rule(type="expression", dxf=dxf, stopIfTrue=True)
+    r2.formula = ['$H2="numerical"']
+    ws.conditional_formatting.add("J2:J{}".format(last_row), r2)
+
+# Species selected by code or scientific name, in the order given and without repetitions
+def _select_species(data, species):
+    by_key = dict()
+    for name, code in data['species']:
+        by_key.setdefault(code, (name, code))
+        by_key.setdefault(name, (name, code))
+    return list(dict.fromkeys(by_key[key] for key in species if key in by_key))
+
+# Rows filled with species and trait, for each trait all selected species
+def _prefilled_rows(data, traits, selected):
+    info = {trait['code']: trait for trait in data['traits']}
+    for code in traits:
+        trait = info[code]
+        for name, spcode in selected:
+            yield [None, None, name, spcode, name, code, trait['name'], trait['value_type']]
+
+def _lookup_row(row):
+    return [None, None, None,
+            """=VLOOKUP($C{}, INDIRECT("SpeciesList"), 2, FALSE)""".format(row),
+            """=VLOOKUP($C{}, INDIRECT("SpeciesList"), 1, FALSE)""".format(row),
+            None,
+            """=VLOOKUP($F{}, INDIRECT("TraitInformation"), 2, FALSE)""".format(row),
+            """=VLOOKUP($F{}, INDIRECT("TraitInformation"), 4, FALSE)""".format(row)]
+
+def _write_entry(wb, data, traits=None, species=None, extra_rows=20):
+    ws = _create_sheet(wb, "Data entry", dict([(col, 25) for col in "ABCEGINO"] + [(col, 12) for col in "DFHJKLM"]), "entry")
+    selected = _select_species(data, species or [])
+    nprefilled = len(traits or []) * len(selected)
+    # the number of rows is needed for the validation ranges before the rows are written
+    last_row = max(nprefilled + extra_rows, 1) + 1
+    for dv in _entry_validations(last_row):
+        ws.data_validations.append(dv)
+    _entry_formatting(ws, last_row)
+    ws.append(entry_header)
+    if nprefilled > 0:
+        for values in _prefilled_rows(data, traits, selected):
+            ws.append(values)
+    for row in range(nprefilled + 2, last_row + 1):
+        ws.append(_lookup_row(row))
+    _add_table(ws, "DataEntry", entry_header, 1, last_row, "Entry")
+    return last_row - 1
+
+## Write one form
+# `traits` and `species` (species codes or scientific names) select the rows that are pre-filled, one row per trait and species, and `extra_rows` empty rows with lookup formulas are added at the end. `contributor` is an optional dictionary with the Name, Affiliation and Contact of the contributor. Returns the number of rows in the data entry table.
+def write_form(filename, data, traits=None, species=None, contributor=None, extra_rows=20):
+    wb = Workbook(write_only=True)
+    _write_instructions(wb)
+    _write_contributor(wb, contributor)
+    nrows = _write_entry(wb, data, traits, species, extra_rows)
+    _write_species(wb, data)
+    _write_references(wb, data)
+    _write_traits(wb, data)
+    _write_vocabularies(wb, data)
+    _write_lookups(wb, data)
+    wb.save(filename)
+    return nrows
+
+def _slug(value):
+    return re.sub(r"[^A-Za-z0-9]+", "-", str(value)).strip("-").lower()
+
+## Form specifications
+# One form per trait, pre-filled with the same `species` (default all species in the list), or one per contributor from a list of dictionaries with Name, Affiliation and Contact and optional `traits` and `species`
+def trait_forms(data, traits=None, species=None, prefix="fireveg-trait-input"):
+    if traits is None:
+        traits = [trait['code'] for trait in data['traits']]
+    if species is None:
+        species = [code for name, code in data['species']]
+    return [{'filename': "%s-%s.xlsx" % (prefix, code), 'traits': [code], 'species': species} for code in traits]
+
+def contributor_forms(contributors, prefix="fireveg-trait-input"):
+    forms = list()
+    for contributor in contributors:
+        forms.append({'filename': "%s-%s.xlsx" % (prefix, _slug(contributor['Name'])),
+                      'traits': contributor.get('traits'), 'species': contributor.get('species'),
+                      'contributor': {field: contributor[field] for field, placeholder in contributor_fields if field in contributor}})
+    return forms
+
+_worker_data = None
+
+def _init_worker(data):
+    global _worker_data
+    _worker_data = data
+
+def _write_form_spec(outdir, form, extra_rows):
+    filename = Path(outdir) / form['filename']
+    nrows = write_form(filename, _worker_data, traits=form.get('traits'), species=form.get('species'),
+                       contributor=form.get('contributor'), extra_rows=extra_rows)
+    return filename, nrows
+
+## Write a list of forms in parallel
+# The form data is sent once to each of the `workers` processes. Returns the file name and number of data entry rows of each form.
+def generate_forms(data, forms, outdir, workers=None, extra_rows=20):
+    from concurrent.futures import ProcessPoolExecutor
+    if not os.path.isdir(outdir):
+        os.makedirs(outdir)
+    if workers is None:
+        workers = min(len(forms), os.cpu_count() or 1)
+    if workers <= 1:
+        _init_worker(data)
+        results = [_write_form_spec(outdir, form, extra_rows) for form in forms]
+    else:
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(data,)) as executor:
+            futures = [executor.submit(_write_form_spec, outdir, form, extra_rows) for form in forms]
+            results = [future.result() for future in futures]
+    for filename, nrows in results:
+        print("%s: %s rows" % (filename, nrows))
+    return results
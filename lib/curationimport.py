@@ -0,0 +1,147 @@
+from pathlib import Path
+import psycopg2
+from lib.curationforms import contributor_fields
+from lib.firevegcache import load_metadata
+from lib.firevegdedup import dedup_upsert
+from lib.prevalidation import rejection_summary, write_rejections
+from lib.recordbatch import RecordBatch
+from lib.vocabularies import as_vocabulary
+
+## Import of manual entry and curation forms
+# The data entry tables of one or more returned forms (module `curationforms`) are read into a single data frame and converted to records column by column: rows are grouped by trait, the value type of each trait comes from `litrev.trait_info`, categorical values are checked against the trait vocabulary and numerical triplets are converted to numbers in one operation per column. The contributor notes are built once per form. Records for each trait are returned as a RecordBatch, and rows that fail the checks are returned as rejections with the same format as module `prevalidation`.
+
+value_columns = ['Raw value', 'Norm value', 'Best', 'Lower', 'Upper']
+triplet_columns = {'Best': 'best', 'Lower': 'lower', 'Upper': 'upper'}
+
+# Strings without surrounding whitespace, empty strings are missing values
+def _clean(series):
+    return series.map(lambda v: (v.strip() or None) if isinstance(v, str) else v)
+
+# Values of a column as a list, with None for missing values
+def _values(series):
+    import pandas as pd
+    return [None if pd.isnull(v) else v for v in series]
+
+def _as_list(series):
+    import pandas as pd
+    return [None if pd.isnull(v) else [str(v)] for v in series]
+
+## Notes added to all records of a form
+# Responses from the Contributor sheet, without the placeholder text of empty forms
+def contributor_notes(contributor):
+    placeholders = set(placeholder.strip() for field, placeholder in contributor_fields)
+    responses = [v for v in _values(_clean(contributor['Your response'])) if v is not None and str(v) not in placeholders]
+    if len(responses) == 0:
+        return []
+    return ['Data entry by'] + [str(v) for v in responses]
+
+## Read the data entry table and contributor details of each form
+# Returns a single data frame with the form and sheet row of each entry, and the contributor notes of each form
+def read_forms(filenames):
+    import pandas as pd
+    entries = list()
+    notes = dict()
+    for filename in filenames:
+        name = Path(filename).name
+        newdata = pd.read_excel(filename, sheet_name='Data entry')
+        contributor = pd.read_excel(filename, sheet_name='Contributor')
+        newdata['form'] = name
+        newdata['row'] = newdata.index + 2
+        entries.append(newdata)
+        notes[name] = contributor_notes(contributor)
+    return pd.concat(entries, ignore_index=True), notes
+
+def _reject(rejections, group, mask, reason):
+    import pandas as pd
+    for row, why in zip(group.loc[mask, ['form', 'row'] + value_columns + ['Trait code', 'Species name']].to_dict(orient='records'), reason[mask]):
+        rejections.append({'record': {k: None if pd.isnull(v) else v for k, v in row.items()}, 'reasons': [why]})
+
+## Records from the data entry tables
+# `info` and `vocabularies` are the `trait_info` and `vocabulary_labels` of the metadata cache. Rows without any value are skipped (e.g. pre-filled rows that were not filled), rows with values but without trait or species are rejected. Returns a dictionary with one RecordBatch per trait and the list of rejections.
+def curation_records(entries, form_notes, info, vocabularies):
+    import pandas as pd
+    rejections = list()
+    entries = entries.copy()
+    for col in ['Main source', 'Original sources', 'Original species name', 'Species code', 'Species name',
+                'Trait code', 'Trait type', 'Raw value', 'Norm value', 'Method of estimation', 'Notes']:
+        entries[col] = _clean(entries[col]) if col in entries else None
+    entries['Species name'] = entries['Species name'].where(entries['Species name'].notna(), entries['Original species name'])
+    has_value = entries[[col for col in value_columns if col in entries]].notna().any(axis=1)
+    entries = entries[has_value]
+    for col, name in (('Trait code', 'trait'), ('Species name', 'species')):
+        missing = entries[col].isna()
+        _reject(rejections, entries, missing, pd.Series("%s is missing" % name, index=entries.index))
+        entries = entries[~missing]
+
+    known = entries['Trait code'].isin(list(info))
+    _reject(rejections, entries, ~known, "trait=" + entries['Trait code'].astype(str) + " not found (litrev.trait_info)")
+    entries = entries[known].copy()
+
+    # notes: contributor notes of the form, original name if it differs, method of estimation and free notes
+    renamed = entries['Original species name'].notna() & (entries['Original species name'] != entries['Species name'])
+    notes = [
+        list(form_notes.get(form, [])) + (['Original species name', orig] if diff else []) +
+        (['Method of estimation', str(method)] if not pd.isnull(method) else []) + ([str(note)] if not pd.isnull(note) else [])
+        for form, diff, orig, method, note in zip(entries['form'], renamed, entries['Original species name'],
+                                                   entries['Method of estimation'], entries['Notes'])]
+    entries['original_notes'] = [v if len(v) > 0 else None for v in notes]
+
+    batches = dict()
+    for trait, group in entries.groupby('Trait code', sort=True):
+        value_type = info[trait]['value_type']
+        codes = pd.to_numeric(group['Species code'], errors='coerce')
+        columns = {'species': _values(group['Species name']),
+                   'species_code': [None if pd.isnull(v) else int(v) for v in codes],
+                   'main_source': _values(group['Main source']),
+                   'original_sources': _as_list(group['Original sources']),
+                   'raw_value': _as_list(group['Raw value']),
+                   'original_notes': group['original_notes'].tolist()}
+        valid = pd.Series(True, index=group.index)
+        if value_type == 'numerical':
+            for col, name in triplet_columns.items():
+                values = _clean(group[col]) if col in group else pd.Series(None, index=group.index, dtype=object)
+                numbers = pd.to_numeric(values, errors='coerce')
+                invalid = values.notna() & numbers.isna()
+                _reject(rejections, group, invalid & valid, name + ": " + values.astype(str) + " is not a number")
+                valid = valid & ~invalid
+                # the triplets are integer values in most traits, keep whole numbers as int
+                columns[name] = [None if pd.isnull(v) else (int(v) if float(v).is_integer() else float(v)) for v in numbers]
+        else:
+            typname = info[trait]['category_vocabulary']
+            vocab = as_vocabulary(vocabularies.get(typname, ()))
+            norm = pd.Series(vocab.normalise(_values(group['Norm value']))[0], index=group.index, dtype=object)
+            invalid = group['Norm value'].notna() & norm.isna()
+            _reject(rejections, group, invalid, "norm_value: " + group['Norm value'].astype(str) + " is not in " + str(typname))
+            valid = valid & ~invalid
+            columns['norm_value'] = _values(norm)
+        keep = valid.tolist()
+        columns = {name: [v for v, k in zip(values, keep) if k] for name, values in columns.items()}
+        batches[trait] = RecordBatch.from_columns(columns, types={'species_code': 'q'})
+    return batches, rejections
+
+## Import a batch of returned forms
+# All forms are read, validated and converted before anything is written, then the records of each trait are inserted with `dedup_upsert`, so forms can be imported again without duplicating records. With `rejections_file` the rejected rows are written as JSON lines. Returns the summary of each trait table and the rejections.
+def import_curation_forms(params, filenames, execute=False, useconn=None, rejections_file=None):
+    if useconn is None:
+        # connect to the PostgreSQL server
+        print('Connecting to the PostgreSQL database...')
+        conn = psycopg2.connect(**params)
+    else:
+        conn = useconn
+    metadata = load_metadata(params, useconn=conn)
+    entries, form_notes = read_forms(filenames)
+    batches, rejections = curation_records(entries, form_notes, metadata['trait_info'], metadata['vocabulary_labels'])
+    print("%s forms, %s entries, %s records, %s rejected" % (
+        len(form_notes), entries.shape[0], sum(len(batch) for batch in batches.values()), len(rejections)))
+    for reason, count in rejection_summary(rejections).most_common():
+        print("  %s: %s" % (reason, count))
+    if rejections_file is not None:
+        write_rejections(rejections, rejections_file)
+    summary = dict()
+    for trait, batch in batches.items():
+        if len(batch) > 0:
+            summary[trait] = dedup_upsert(params, 'litrev.%s' % trait, batch, execute=execute, useconn=conn)
+    if useconn is None and conn is not None:
+        conn.close()
+        print('Database connection closed.')
+    return summary, rejections
@@ -1,13 +1,16 @@
 import openpyxl
-from datetime import datetime
+from datetime import datetime, date
+import calendar
+import functools
 import re
-import copy
 
 # Create field site records
 def create_field_site_record(item,sw):
     site_label = item[sw['site_label']].value
     if site_label is not None and site_label != "Site":
         record={'site_label': site_label}
+        xlon = ylat = None
+        srid = False
     
         for column in ('elevation','location_description', 'gps_uncertainty_m', 'gps_geom_description'):
             if column in sw.keys():
@@ -43,11 +46,28 @@ def create_field_site_record(item,sw):
                 srid = False
 
    
+        # geometry is kept as a typed (x, y, srid) tuple, see firevegdb.GEOM_TEMPLATE
         if srid and xlon and ylat:
-            record['geom'] = "ST_GeomFromText('POINT({xlon} {ylat})', {srid})".format(xlon=xlon,ylat=ylat,srid=srid)
+            record['geom'] = (float(xlon), float(ylat), srid)
 
         return(record)
 
+# Reproject the point geometries of field site records to a single `target_srid`
+# Coordinates are transformed in one vectorised call per source srid (e.g. MGA zones 54, 55 and 56), records are updated in place.
+def reproject_site_records(records, target_srid=4326):
+    from pyproj import Transformer
+    groups=dict()
+    for record in records:
+        geom=record.get('geom')
+        if isinstance(geom, tuple) and geom[2] != target_srid:
+            groups.setdefault(geom[2], list()).append(record)
+    for srid, group in groups.items():
+        transformer = Transformer.from_crs("EPSG:%s" % srid, "EPSG:%s" % target_srid, always_xy=True)
+        xs, ys = transformer.transform([r['geom'][0] for r in group], [r['geom'][1] for r in group])
+        for record, x, y in zip(group, xs, ys):
+            record['geom'] = (float(x), float(y), target_srid)
+    return records
+
 # Create field visit records
 def create_field_visit_record(item,sw):
     site_label = item[sw['site_label']].value
@@ -69,10 +89,134 @@ def create_field_visit_record(item,sw):
                 records.append(record)
     return records
 
+# Parse fire dates
+# Fire dates are recorded in many formats in the field forms: dates, years, decades, year ranges, bounds with `<`, `>` or `pre`, month and year (`Jan 2020`, `__/01/2020`, `1/2021`), and day/month/year strings. All of them are translated to an interval of `earliest_date` and `latest_date`, open bounds are left as None.
+
+months = {m.lower(): k for k, m in enumerate(calendar.month_abbr) if m}
+months.update({m.lower(): k for k, m in enumerate(calendar.month_name) if m})
+part_of_month = {'early': (1, 15), 'mid': (10, 20), 'late': (15, 31)}
+
+# Patterns for the fire date formats found in the field forms, digits are matched with [0-9] because `\d` also matches non-ASCII digits
+re_year = re.compile(r"^([0-9]{4})$")
+re_decade = re.compile(r"^([0-9]{3})0'?s$")
+re_year_range = re.compile(r"^([0-9]{4})\s*[-\u2013]\s*([0-9]{4}|[0-9]{2})$")
+re_iso_date = re.compile(r"^([0-9]{4})-([0-9]{1,2})-([0-9]{1,2})$")
+re_dmy = re.compile(r"^([0-9]{1,2}|__)/([0-9]{1,2})/([0-9]{4}|[0-9]{2})$")
+re_month_year = re.compile(r"^([0-9]{1,2})/([0-9]{4})$")
+re_month_name = re.compile(r"^(?:(early|mid|late)\s+)?([a-z]+)\.?\s+([0-9]{4})$")
+re_bound = re.compile(r"^(<|>|pre|post|before|after)\s*~?\s*([0-9]{4})$")
+re_years_ago = re.compile(r"^([<>])\s*([0-9]+)\s*(?:yrs|years)$")
+
+def _full_year(y):
+    y = int(y)
+    if y < 100:
+        y = y + 2000
+    return y
+
+def _month_interval(year, month, days=(1, 31)):
+    last = calendar.monthrange(year, month)[1]
+    return date(year, month, min(days[0], last)), date(year, month, min(days[1], last))
+
+# Translate one string value to an (earliest_date, latest_date) interval, or None if the format is not recognised
+def _parse_date_string(vals, reference_year=None):
+    v = vals.strip().lower()
+    m = re_year.match(v)
+    if m:
+        y = int(m.group(1))
+        return date(y, 1, 1), date(y, 12, 31)
+    m = re_decade.match(v)
+    if m:
+        y = int(m.group(1)) * 10
+        return date(y, 1, 1), date(y + 9, 12, 31)
+    m = re_year_range.match(v)
+    if m:
+        y1 = int(m.group(1))
+        y2 = m.group(2)
+        if len(y2) == 2:
+            y2 = m.group(1)[0:2] + y2
+        return date(y1, 1, 1), date(int(y2), 12, 31)
+    m = re_iso_date.match(v)
+    if m:
+        d = date(int(m.group(1)), int(m.group(2)), int(m.group(3)))
+        return d, d
+    m = re_dmy.match(v)
+    if m:
+        year = _full_year(m.group(3))
+        month = int(m.group(2))
+        if m.group(1) == '__':
+            return _month_interval(year, month)
+        d = date(year, month, int(m.group(1)))
+        return d, d
+    m = re_month_year.match(v)
+    if m:
+        return _month_interval(int(m.group(2)), int(m.group(1)))
+    m = re_month_name.match(v)
+    if m and m.group(2) in months:
+        days = part_of_month.get(m.group(1), (1, 31))
+        return _month_interval(int(m.group(3)), months[m.group(2)], days)
+    m = re_bound.match(v)
+    if m:
+        y = int(m.group(2))
+        if m.group(1) in ('<', 'pre', 'before'):
+            return None, date(y, 12, 31)
+        return date(y, 1, 1), None
+    m = re_years_ago.match(v)
+    if m and reference_year is not None:
+        y = reference_year - int(m.group(2))
+        if m.group(1) == '>':
+            return None, date(y, 12, 31)
+        return date(y, 1, 1), None
+    return None
+
+# Parse a single fire date value from the field forms
+# Returns a tuple with the fire date as a string, the earliest and latest dates and a tuple of notes. Results are memoised, repeated values in a sheet are only parsed once. Use `reference_year` to translate values given as time since fire (e.g. `>30yrs`).
+@functools.lru_cache(maxsize=None)
+def parse_fire_date(vals, reference_year=None):
+    if isinstance(vals, datetime):
+        d = vals.date()
+        return str(d), d, d, ()
+    if isinstance(vals, date):
+        return str(vals), vals, vals, ()
+    if isinstance(vals, int):
+        if vals > 0:
+            return str(vals), date(vals, 1, 1), date(vals, 12, 31), ()
+        return str(vals), None, None, ('Fire date is missing or empty',)
+    if isinstance(vals, float) and vals.is_integer():
+        return parse_fire_date(int(vals), reference_year)
+    vals = str(vals)
+    if re_year.match(vals.strip()):
+        y = int(vals)
+        return vals, date(y, 1, 1), date(y, 12, 31), ()
+    comms = ['Fire date given as: %s' % vals]
+    for i in re.findall("[<>]", vals):
+        comms.append('max/min value given')
+    try:
+        interval = _parse_date_string(vals, reference_year)
+    except ValueError:
+        interval = None
+    if interval is None:
+        comms.append('Fire date could not be interpreted')
+        return vals, None, None, tuple(comms)
+    return vals, interval[0], interval[1], tuple(comms)
+
+# Reference year for the records of one site, `reference_year` is a single year or a dictionary of years by site label (e.g. the year of the first visit to each site)
+def site_reference_year(reference_year, site_label):
+    if isinstance(reference_year, dict):
+        return reference_year.get(site_label)
+    return reference_year
+
+# Parse a column of fire date values, each distinct value is parsed only once
+def parse_fire_dates(values, reference_year=None):
+    parsed = dict()
+    for vals in values:
+        if vals is not None and vals not in parsed:
+            parsed[vals] = parse_fire_date(vals, reference_year)
+    return [parsed.get(vals) for vals in values]
+
 # Create fire history records
 # This is a lower level function that will create a field sample record from an item (a row in the spreadsheet), using the dictionary or "switch" in col_dicts:
 
-def create_fire_history_record(item,col_dicts):
+def create_fire_history_record(item,col_dicts,reference_year=None):
     records=list()
     for sw in col_dicts:
         record=dict()
@@ -83,39 +227,13 @@ def create_fire_history_record(item,col_dicts):
             vals=item[sw[k]].value
             if vals is not None:
                 if k == 'fire_date':
-                    if isinstance(vals,datetime):
-                        record['fire_date']=str(vals.date())
-                        record['earliest_date']=vals.date()
-                        record['latest_date']=vals.date()
-                    elif isinstance(vals,int):
-                        record['fire_date']=str(vals)
-                        if vals>0:
-                            record['earliest_date']=datetime(vals,1,1).date()
-                            record['latest_date']=datetime(vals,12,31).date()
-                        else:
-                            comms.append('Fire date is missing or empty')
-                    elif vals.isnumeric():
-                        record['fire_date']=str(vals)
-                        record['earliest_date']=datetime(int(vals),1,1).date()
-                        record['latest_date']=datetime(int(vals),12,31).date()
-                    else:
-                        record['fire_date']=vals
-                        comms.append('Fire date given as: %s' % vals)
-                        found=re.findall("[<>]",vals)
-                        for i in found:
-                            comms.append('max/min value given')
-                            vals=vals.replace(i,"")
-                        ws=vals.split("-")
-                        if len(ws)==2:
-                            if len(ws[0])==4 and ws[0].isnumeric():
-                                record['earliest_date']=datetime(int(ws[0]),1,1).date()
-                            if len(ws[1])==4 and ws[1].isnumeric():
-                                record['latest_date']=datetime(int(ws[1]),12,31).date()
-                            elif len(ws[1])==2 and ws[1].isnumeric():
-                                fch2=ws[0][0:2]+ws[1]
-                                record['latest_date']=datetime(int(fch2),12,31).date()
-    
-                            
+                    fire_date, earliest, latest, notes = parse_fire_date(vals, site_reference_year(reference_year, item[sw['site_label']].value))
+                    record['fire_date']=fire_date
+                    if earliest is not None:
+                        record['earliest_date']=earliest
+                    if latest is not None:
+                        record['latest_date']=latest
+                    comms.extend(notes)
                 else:
                     record[k]=vals
         if len(comms)>0:
@@ -156,7 +274,11 @@ def create_field_sample_record(item,sw):
         return(record)
 
 
+# valid_seedbank and valid_organ can be lists or sets of labels (e.g. from firevegcache.vocabulary) or compiled vocabularies, compile them once with `as_vocabulary` before reading a worksheet
 def create_quadrat_sample_record(item,sw,lookup,valid_seedbank,valid_organ):
+    from lib.vocabularies import as_vocabulary
+    seedbank_vocab = as_vocabulary(valid_seedbank)
+    organ_vocab = as_vocabulary(valid_organ)
     species = item[sw['species']].value
     visit_id =  item[sw['visit_id']].value
     comms=list()
@@ -223,17 +345,13 @@ def create_quadrat_sample_record(item,sw,lookup,valid_seedbank,valid_organ):
                 vals=item[sw[k]].value
                 if vals is not None and vals not in ('na','NA'):
                     if k == 'resprout_organ':
-                        if vals in valid_organ:
-                            record[k]=vals
-                        elif vals.capitalize() in valid_organ:
-                            record[k]=vals.capitalize()
+                        if vals in organ_vocab:
+                            record[k]=organ_vocab.get(vals)
                         else:
                             comms.append("resprout organ written as %s" % vals)
                     elif k == 'seedbank':
-                        if vals in valid_seedbank:
-                            record[k]=vals
-                        elif vals.capitalize() in valid_seedbank:
-                            record[k]=vals.capitalize()
+                        if vals in seedbank_vocab:
+                            record[k]=seedbank_vocab.get(vals)
                         else:
                             comms.append("seedbank written as %s" % vals)
                     elif k == 'notes':
@@ -275,161 +393,295 @@ def import_records_from_workbook(filepath, workbook, worksheet, col_dictionary,
                 records.append(record)
     return records
 
-def read_fire_intensity(filepath,workbook,worksheet,col_definitions):
-    wb = openpyxl.load_workbook(filepath / workbook,data_only=True)
-    ws = wb[worksheet]
-    triplet=('best','lower','upper')
+# Declarative column specifications for the visit measurement readers
+# Each spec describes the variables in a worksheet: how values are given (a best/lower/upper `triplet` or `single` raw values), their units, the label of the measured variable and any comment columns. `compile_visit_spec` translates a spec and the column definitions of one worksheet into a row extractor, `read_visit_measurements` applies it to all rows of the worksheet.
+
+triplet=('best','lower','upper')
+
+fire_intensity_spec = {
+    'null_date': 'NULL',
+    'variables': {
+        'scorch height': {'units': 'm'},
+        'tree foliage biomass consumed': {'units': '%'},
+        'shrub foliage biomass consumed': {'units': '%'},
+        'ground foliage biomass consumed': {'units': '%'},
+        'tree foliage scorch': {'units': '%'},
+        'shrub foliage scorch': {'units': '%'},
+        'herb foliage scorch': {'units': '%'},
+        'peat extent burnt': {'units': '%'},
+        'peat depth burnt': {'units': 'cm'}}
+}
+
+twig_diameter_spec = {
+    'null_date': 'NULL',
+    'var_key': 'measured_variable',
+    'variables': {
+        'twig diameter': {'units': 'mm', 'values': 'single'}}
+}
+
+veg_structure_spec = {
+    'label': 'stratum {stratum} {var}',
+    'label_columns': ('stratum',),
+    'comment_columns': (('stage', 'Stage: %s'),),
+    'variables': {'height': {}, 'cover': {}, 'scorch': {}}
+}
+
+# Rename vegetation classes and formations to the names used in the database
+# Renames of vegetation classes and formations are read from the `vegetation` section of vocabulary-mappings.yml
+def normalise_veg_class(record):
+    # the mappings file is only read when vegetation classes are imported
+    from lib.vocabularies import vocabularies, read_mappings
+    tables=vocabularies('vegetation')
+    vegclass=record['vegetation_class']
+    vegformation=record['vegetation_formation']
+    # classes are matched exactly, folded matches would move correctly spelled classes to the formation of a variant
+    newformation=read_mappings()['vegetation']['formation_of_class'].get(vegclass, tables['vegetation_formation'].get(vegformation, vegformation))
+    newclass=tables['vegetation_class'].get(vegclass, vegclass)
+    if vegformation in read_mappings()['vegetation']['title_case_formations'] and newclass is not None:
+        newclass=newclass.title()
+    record['vegetation_formation']=newformation
+    record['vegetation_class']=newclass
+    return record
+
+veg_class_spec = {
+    'columns': ('vegetation_formation', 'vegetation_class'),
+    'normalise': normalise_veg_class
+}
+
+@functools.lru_cache(maxsize=None)
+def _strpdate(val):
+    return datetime.strptime(val, '%d/%m/%Y').date()
+
+def _visit_date(val, null_date=None):
+    if isinstance(val,datetime):
+        return val.date()
+    elif val is None:
+        return null_date
+    else:
+        return _strpdate(val)
+
+# Compile a spec into a function that takes the values of one row (a tuple) and returns a list of records
+# Column numbers in `col_definitions` start at 1, as in `ws.cell(row, col)`. Rows without visit date are skipped unless the spec defines a `null_date`.
+def compile_visit_spec(spec, col_definitions):
+    ivisit = col_definitions['visit_id'] - 1
+    idate = col_definitions['visit_date'] - 1
+    null_date = spec.get('null_date')
+    var_key = spec.get('var_key', 'measured_var')
+    label = spec.get('label', '{var}')
+    label_cols = [(k, col_definitions[k] - 1) for k in spec.get('label_columns', ())]
+    comment_cols = [(col_definitions[k] - 1, fmt) for k, fmt in spec.get('comment_columns', ()) if k in col_definitions]
+    fixed_cols = [(k, col_definitions[k] - 1) for k in spec.get('columns', ())]
+    normalise = spec.get('normalise')
+    variables = list()
+    for var, opts in spec.get('variables', {}).items():
+        if var in col_definitions:
+            cols = tuple(c - 1 for c in col_definitions[var])
+            variables.append((var, opts.get('units'), opts.get('values', 'triplet') == 'single', cols))
+    # rows read in read-only mode can be shorter than the last column used
+    width = 1 + max([ivisit, idate] + [i for k, i in label_cols + fixed_cols] +
+                    [i for i, fmt in comment_cols] + [max(v[3], default=0) for v in variables])
+
+    def extract(row):
+        records=list()
+        if len(row) < width:
+            row = tuple(row) + (None,) * (width - len(row))
+        visitid = row[ivisit]
+        if visitid is None or visitid == 'Site':
+            return records
+        visitdate = _visit_date(row[idate], null_date)
+        if visitdate is None:
+            return records
+        if len(fixed_cols) > 0:
+            record = {'visit_id': visitid, 'visit_date': visitdate}
+            for k, i in fixed_cols:
+                record[k] = row[i]
+            if normalise is not None:
+                record = normalise(record)
+            records.append(record)
+        comments = [fmt % row[i] for i, fmt in comment_cols if row[i] is not None]
+        labels = {k: row[i] for k, i in label_cols}
+        for var, units, single, cols in variables:
+            name = label.format(var=var, **labels)
+            if single:
+                for i in cols:
+                    val = row[i]
+                    if val is not None and val != 'NA':
+                        records.append({'visit_id': visitid, 'visit_date': visitdate,
+                                        var_key: name, 'units': units, 'single_value': val})
+                continue
+            record = {'visit_id': visitid, 'visit_date': visitdate, var_key: name}
+            if units is not None:
+                record['units'] = units
+            comment = list(comments)
+            for k, i in enumerate(cols):
+                val = row[i]
+                if val is None or val == 'NA':
+                    continue
+                best = record.get('best')
+                if triplet[k]=='lower' and best is not None and val > best:
+                    record['lower']=best
+                    comment.append('lower bound given as %s but greater than best estimate' % val)
+                elif triplet[k]=='upper' and best is not None and val < best:
+                    record['upper']=best
+                    comment.append('upper bound given as %s but less than best estimate' % val)
+                else:
+                    record[triplet[k]]=val
+            if len(comment)>0:
+                record['comment']=comment
+            records.append(record)
+        return records
+    return extract
+
+# Read all rows of a worksheet with a compiled spec, the workbook is opened in read-only mode and rows are read as tuples of values
+def read_visit_measurements(filepath,workbook,worksheet,col_definitions,spec):
+    extract = compile_visit_spec(spec, col_definitions)
+    wb = openpyxl.load_workbook(filepath / workbook, data_only=True, read_only=True)
     records=list()
-    for row in range(2,ws.max_row+1):
-        visitid=ws.cell(row,col_definitions['visit_id']).value
-        if visitid is not None and visitid != 'Site':
-            visitdate=ws.cell(row,col_definitions['visit_date']).value
-            if isinstance(visitdate,datetime):
-                visitdate=visitdate.date()
-            elif visitdate is None:
-                visitdate='NULL'
-            else:
-                visitdate=datetime.strptime(visitdate, '%d/%m/%Y').date()
-            
-            record={'visit_id': visitid,
-                    'visit_date': visitdate,
-                   'comment':list()}
-            #print(record)
-            for var in ('scorch height',
-                        'tree foliage biomass consumed', 'shrub foliage biomass consumed', 'ground foliage biomass consumed',
-                        'tree foliage scorch', 'shrub foliage scorch', 'herb foliage scorch',
-                        'peat extent burnt','peat depth burnt'
-                       ):
-                if var in col_definitions.keys():
-                    record1=copy.deepcopy(record)
-                    record1['measured_var']=var
-                    if var == 'scorch height':
-                        record1['units']='m'
-                    elif var == 'peat depth burnt':
-                        record1['units']='cm'
-                    else:
-                        record1['units']='%'
-                    for k in range(len(col_definitions[var])):
-                        val=ws.cell(row,col_definitions[var][k]).value
-                        if val is not None and val != 'NA':
-                            if triplet[k]=='lower' and 'best' in record1.keys() and val > record1['best']:
-                                record1['lower']=record1['best']
-                                record1['comment'].append('lower bound given as %s but greater than best estimate' % val)
-                            if triplet[k]=='upper' and 'best' in record1.keys() and val < record1['best']:
-                                record1['comment'].append('upper bound given as %s but less than best estimate' % val)
-                                record1['upper']=record1['best']
-                            else:
-                                record1[triplet[k]]=val
-                    #print(record1)
-                    if 'comment' in record1.keys() and len(record1['comment'])==0:
-                        record1.pop('comment')
-                    records.append(record1)
+    try:
+        for row in wb[worksheet].iter_rows(min_row=2, values_only=True):
+            records.extend(extract(row))
+    finally:
+        wb.close()
     return records
 
+def read_fire_intensity(filepath,workbook,worksheet,col_definitions):
+    return read_visit_measurements(filepath,workbook,worksheet,col_definitions,fire_intensity_spec)
+
 # Add raw measurements for a single variable
 def read_twig_diameters(filepath,workbook,worksheet,col_definitions):
-    wb = openpyxl.load_workbook(filepath / workbook,data_only=True)
-    ws = wb[worksheet]
-    records=list()
-    for row in range(2,ws.max_row+1):
-        visitid=ws.cell(row,col_definitions['visit_id']).value
-        if visitid is not None and visitid != 'Site':
-            visitdate=ws.cell(row,col_definitions['visit_date']).value
-            if isinstance(visitdate,datetime):
-                visitdate=visitdate.date()
-            elif visitdate is None:
-                visitdate='NULL'
-            else:
-                visitdate=datetime.strptime(visitdate, '%d/%m/%Y').date()
-             
-            for var in ('twig diameter',):
-                if var in col_definitions.keys():
-                    record={'visit_id': visitid,
-                        'visit_date': visitdate,
-                        'measured_variable': var,
-                        'units':'mm'
-                       }
-                    for k in range(len(col_definitions[var])):
-                        record1=copy.deepcopy(record)
-                        val=ws.cell(row,col_definitions[var][k]).value
-                        if val is not None and val != 'NA':
-                            record1['single_value']=val
-                            records.append(record1)
-    return records
+    return read_visit_measurements(filepath,workbook,worksheet,col_definitions,twig_diameter_spec)
 
 # I defined this function to read vegetation information from each worksheet.
 def read_veg_classes(filepath,workbook,worksheet,col_definitions):
-    wb = openpyxl.load_workbook(filepath / workbook,data_only=True)
-    ws = wb[worksheet]
+    return read_visit_measurements(filepath,workbook,worksheet,col_definitions,veg_class_spec)
+
+def read_veg_structure(filepath,workbook,worksheet,col_definitions):
+    return read_visit_measurements(filepath,workbook,worksheet,col_definitions,veg_structure_spec)
+
+## Workbooks with one worksheet per site
+# Some workbooks (e.g. the Newnes survey) have one worksheet per site (`BS1`, `BS2`, `MW1`, ...) with blocks of data located next to labels such as "Sample Identifier" or "Fire History". A sheet spec gives the `labels` to find (text to search, and row and column offset of the value from the label) and the `table` blocks (text of the anchor cell, the headers to read in the row of the anchor, and the number of rows below it). Labels are searched in the first `search_rows` rows and `search_cols` columns of each sheet. The `records` function of the spec creates records from the extracted block of one sheet.
+
+def fire_history_block_records(block, reference_year=None):
     records=list()
-    for row in range(2,ws.max_row+1):
-        visitid=ws.cell(row,col_definitions['visit_id']).value
-        if visitid is not None and visitid != 'Site':
-            visitdate=ws.cell(row,col_definitions['visit_date']).value
-            if isinstance(visitdate,datetime):
-                visitdate=visitdate.date()
+    site_label=block['labels'].get('site_label')
+    if isinstance(site_label,str):
+        site_label=site_label.strip(" ")
+    for row in block['tables'].get('fire_history', []):
+        record={'site_label':site_label}
+        comms=list()
+        for k, vals in row.items():
+            if vals is None:
+                continue
+            if k == 'fire_date':
+                fire_date, earliest, latest, notes = parse_fire_date(vals, site_reference_year(reference_year, site_label))
+                record['fire_date']=fire_date
+                if earliest is not None:
+                    record['earliest_date']=earliest
+                if latest is not None:
+                    record['latest_date']=latest
+                comms.extend(notes)
             else:
-                visitdate=datetime.strptime(visitdate, '%d/%m/%Y').date()
-            vegclass=ws.cell(row,col_definitions['vegetation_class']).value
-            vegformation=ws.cell(row,col_definitions['vegetation_formation']).value
-            if vegclass=='Warm temperate rainforests':
-                vegclass='Southern Warm Temperate Rainforests'
-            if vegclass=='Littoral rainforest':
-                vegclass='Littoral rainforests'
-            if vegformation=='Rainforests':
-                vegclass=vegclass.title()
-            if vegformation in ('Blue Mountains Cool Wet Eucalypt Forest','Wet Sclerophyll Forests (Shrubby sub-formation)'):
-                vegformation='Wet sclerophyll forests (Shrubby subformation)'
-            if vegclass=='Southern Tableland Wet Sclerophyll Forests':
-                vegformation='Wet sclerophyll forests (Grassy subformation)'
-            if vegclass=='Montane wet sclerophyll forests':
-                vegformation='Wet sclerophyll forests (Grassy subformation)'
-                vegclass='Montane Wet Sclerophyll Forests'
-            if vegclass=='Alpine bogs and fens':
-                vegclass='Alpine Bogs and Fens'
-            
-            record={'visit_id': visitid,
-            'visit_date': visitdate,
-            'vegetation_formation':vegformation,
-                'vegetation_class':vegclass}
+                record[k]=vals
+        if len(comms)>0:
+            record['notes'] = comms
+        if len(record)>1:
             records.append(record)
     return records
 
-def read_veg_structure(filepath,workbook,worksheet,col_definitions):
-    wb = openpyxl.load_workbook(filepath / workbook,data_only=True)
-    ws = wb[worksheet]
-    triplet=('best','lower','upper')
+site_fire_history_spec = {
+    'search_rows': 5,
+    'search_cols': 5,
+    'labels': {'site_label': ('Sample Identifier', 0, 2)},
+    'tables': {
+        'fire_history': {
+            'anchor': 'Fire History',
+            'headers': {'Date': 'fire_date', 'How inferred': 'how_inferred', 'Cause of ignition': 'cause_of_ignition'},
+            'width': 10,
+            'nrows': 3
+        }
+    },
+    'records': fire_history_block_records
+}
+
+# Find the first cell containing `text`, returns the (row, column) position starting from 0, or None
+def find_label(rows, text, search_rows=None, search_cols=None):
+    for i, row in enumerate(rows[:search_rows]):
+        for j, val in enumerate(row[:search_cols]):
+            if isinstance(val,str) and val.find(text)>=0:
+                return i, j
+    return None
+
+def _cell(rows, i, j):
+    if i < len(rows) and j < len(rows[i]):
+        return rows[i][j]
+    return None
+
+def extract_sheet_block(rows, spec):
+    block={'labels': dict(), 'tables': dict()}
+    for k, (text, drow, dcol) in spec.get('labels', {}).items():
+        pos=find_label(rows, text, spec.get('search_rows'), spec.get('search_cols'))
+        if pos is not None:
+            block['labels'][k]=_cell(rows, pos[0]+drow, pos[1]+dcol)
+    for k, table in spec.get('tables', {}).items():
+        pos=find_label(rows, table['anchor'], spec.get('search_rows'), spec.get('search_cols'))
+        if pos is None:
+            continue
+        i, j = pos
+        index={table['headers'][val]: c for c in range(j, j+table['width'])
+               for val in (_cell(rows, i, c),) if val in table['headers']}
+        block['tables'][k]=[{name: _cell(rows, r, c) for name, c in index.items()}
+                            for r in range(i+1, i+1+table['nrows'])]
+    return block
+
+# Number of rows and columns of each sheet that need to be read for a spec
+def _spec_extent(spec):
+    search_rows=spec.get('search_rows') or 0
+    search_cols=spec.get('search_cols') or 0
+    nrows=[search_rows]+[search_rows+drow for text, drow, dcol in spec.get('labels', {}).values()]
+    ncols=[search_cols]+[search_cols+dcol for text, drow, dcol in spec.get('labels', {}).values()]
+    for table in spec.get('tables', {}).values():
+        nrows.append(search_rows+table['nrows'])
+        ncols.append(search_cols+table['width'])
+    return max(nrows), max(ncols)
+
+# Read a group of sheets of a workbook, this runs in a worker process
+def read_sheet_blocks(path, sheets, spec, **kwargs):
+    nrows, ncols = _spec_extent(spec)
+    wb = openpyxl.load_workbook(path, data_only=True, read_only=True)
     records=list()
-    for row in range(2,ws.max_row+1):
-        visitid=ws.cell(row,col_definitions['visit_id']).value
-        if visitid is not None and visitid != 'Site':
-            visitdate=ws.cell(row,col_definitions['visit_date']).value
-            if isinstance(visitdate,datetime):
-                visitdate=visitdate.date()
-            else:
-                visitdate=datetime.strptime(visitdate, '%d/%m/%Y').date()
-            record={'visit_id': visitid,
-            'visit_date': visitdate}
-            
-            stage=ws.cell(row,col_definitions['stage']).value
-            if stage is not None:
-                record['comment']=['Stage: %s' % stage,]
-            stratum=ws.cell(row,col_definitions['stratum']).value
-            for var in ('height','cover','scorch'):
-                if var in col_definitions.keys():
-                    record1=copy.deepcopy(record)
-                    record1['measured_var']='stratum %s %s' % (stratum,var)
-                    for k in range(len(col_definitions[var])):
-                        val=ws.cell(row,col_definitions[var][k]).value
-                        if val is not None and val != 'NA':
-                            if triplet[k]=='lower' and 'best' in record1.keys() and val > record1['best']:
-                                record1['lower']=record1['best']
-                                record1['comment'].append('lower bound given as %s but greater than best estimate' % val)
-                            if triplet[k]=='upper' and 'best' in record1.keys() and val < record1['best']:
-                                record1['comment'].append('upper bound given as %s but less than best estimate' % val)
-                                record1['upper']=record1['best']
-                            else:
-                                record1[triplet[k]]=val
-                    records.append(record1)
+    try:
+        for sheet in sheets:
+            rows=[tuple(row) for row in wb[sheet].iter_rows(min_row=1, max_row=nrows, max_col=ncols, values_only=True)]
+            records.extend(spec['records'](extract_sheet_block(rows, spec), **kwargs))
+    finally:
+        wb.close()
     return records
 
+def site_sheets(path, pattern=r"^[A-Z]+[0-9]+$"):
+    wb = openpyxl.load_workbook(path, read_only=True)
+    try:
+        return [name for name in wb.sheetnames if re.match(pattern, name)]
+    finally:
+        wb.close()
+
+## Read the same block from all site sheets of a workbook
+# Sheets are found by `pattern` (or given in `sheets`) and split among `workers` processes. Each worker opens the workbook in read-only mode and reads only the top rows and columns of its sheets that the spec needs. Records are returned in the order of the sheets.
+def read_site_sheets(filepath, workbook, spec, sheets=None, pattern=r"^[A-Z]+[0-9]+$", workers=None, **kwargs):
+    from concurrent.futures import ProcessPoolExecutor
+    import os
+    path = filepath / workbook
+    if sheets is None:
+        sheets = site_sheets(path, pattern)
+    if workers is None:
+        workers = min(len(sheets), os.cpu_count() or 1)
+    if workers <= 1:
+        return read_sheet_blocks(path, sheets, spec, **kwargs)
+    # contiguous groups of sheets, so that each worker opens the workbook once and records keep the order of the sheets
+    size = -(-len(sheets) // workers)
+    groups = [sheets[i:i+size] for i in range(0, len(sheets), size)]
+    records=list()
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(read_sheet_blocks, path, group, spec, **kwargs) for group in groups]
+        for future in futures:
+            records.extend(future.result())
+    return records
@@ -0,0 +1,156 @@
+import hashlib
+import json
+import time
+from pathlib import Path
+import psycopg2
+
+## Local cache for database vocabularies and trait metadata
+# Enum vocabularies (labels and comments) and the content of `litrev.trait_info` are loaded in a single connection and saved in a local file. Within `ttl` seconds the file is used without querying the database; after that, a cheap fingerprint query checks if anything changed before reloading. Each database (host, port and database name) has its own cache file and memory entry. Vocabularies are returned as frozensets and the other metadata as dictionaries. Site labels change with every field form import, so they are not cached and `site_labels` always queries `form.field_site`.
+
+default_cache_file = Path.home() / '.cache' / 'fireveg' / 'metadata.json'
+default_ttl = 24 * 60 * 60
+
+qry_fingerprint = """
+SELECT md5(concat_ws('|',
+  (SELECT count(*) || ':' || coalesce(sum(hashtext(enumlabel)), 0) FROM pg_enum),
+  (SELECT coalesce(sum(hashtext(coalesce(obj_description(oid, 'pg_type'), ''))), 0) FROM pg_type WHERE typtype = 'e'),
+  (SELECT count(*) || ':' || coalesce(sum(hashtext(t::text)), 0) FROM litrev.trait_info t)));
+"""
+
+qry_vocabularies = """
+SELECT t.typname, e.enumlabel
+FROM pg_enum e LEFT JOIN pg_type t ON e.enumtypid = t.oid
+ORDER BY t.typname, e.enumsortorder;
+"""
+
+qry_descriptions = """
+SELECT typname, pg_catalog.obj_description(oid, 'pg_type')
+FROM pg_type WHERE typtype = 'e';
+"""
+
+qry_trait_info = """
+SELECT code, name, description, value_type, life_stage, life_history_process,
+       priority, category_vocabulary, method_vocabulary
+FROM litrev.trait_info ORDER BY code;
+"""
+
+_memory = dict()
+
+# Short hash of the connection parameters that identify a database, `database` and `dbname` are both accepted by psycopg2
+def _database_key(params):
+    ident = '|'.join(str(params.get(k) or '') for k in ('host', 'port')) + '|' + str(params.get('database') or params.get('dbname') or '')
+    return hashlib.sha1(ident.encode('utf-8')).hexdigest()[:12]
+
+# Cache file of one database, e.g. `metadata-<key>.json` next to `cache_file`
+def _cache_path(params, cache_file):
+    cache_file = Path(cache_file)
+    return cache_file.with_name('%s-%s%s' % (cache_file.stem, _database_key(params), cache_file.suffix))
+
+def _fingerprint(cur):
+    cur.execute(qry_fingerprint)
+    return cur.fetchone()[0]
+
+def _query_metadata(cur):
+    metadata = {'vocabularies': dict(), 'vocabulary_descriptions': dict(), 'trait_info': dict()}
+    cur.execute(qry_vocabularies)
+    for typname, label in cur.fetchall():
+        metadata['vocabularies'].setdefault(typname, list()).append(label)
+    cur.execute(qry_descriptions)
+    for typname, description in cur.fetchall():
+        if description is not None:
+            try:
+                description = json.loads(description)
+            except ValueError:
+                pass
+        metadata['vocabulary_descriptions'][typname] = description
+    cur.execute(qry_trait_info)
+    names = [col[0] for col in cur.description]
+    for row in cur.fetchall():
+        metadata['trait_info'][row[0]] = dict(zip(names, row))
+    return metadata
+
+# Convert the lists in the cached file to frozensets and keep the ordered labels of each vocabulary
+def _freeze(metadata):
+    frozen = dict(metadata)
+    frozen['vocabulary_labels'] = {k: tuple(v) for k, v in metadata['vocabularies'].items()}
+    frozen['vocabularies'] = {k: frozenset(v) for k, v in metadata['vocabularies'].items()}
+    return frozen
+
+def _read_cache_file(cache_file):
+    try:
+        with open(cache_file) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def _write_cache_file(cache_file, cached):
+    cache_file = Path(cache_file)
+    cache_file.parent.mkdir(parents=True, exist_ok=True)
+    tmpfile = cache_file.with_suffix('.tmp')
+    with open(tmpfile, 'w') as f:
+        json.dump(cached, f, default=str)
+    tmpfile.replace(cache_file)
+
+## Get the cached metadata, loading it from the database if needed
+def load_metadata(params, cache_file=default_cache_file, ttl=default_ttl, refresh=False, useconn=None):
+    cache_file = _cache_path(params, cache_file)
+    key = str(cache_file)
+    cached = _memory.get(key)
+    if cached is None:
+        cached = _read_cache_file(cache_file)
+    if cached is not None and not refresh and time.time() - cached['checked'] < ttl:
+        if key not in _memory:
+            _memory[key] = dict(cached, frozen=_freeze(cached['metadata']))
+        return _memory[key]['frozen']
+
+    if useconn is None:
+        conn = psycopg2.connect(**params)
+    else:
+        conn = useconn
+    cur = conn.cursor()
+    fingerprint = _fingerprint(cur)
+    if refresh or cached is None or cached['fingerprint'] != fingerprint:
+        cached = {'fingerprint': fingerprint, 'metadata': _query_metadata(cur)}
+    cached = {'fingerprint': fingerprint, 'checked': time.time(), 'metadata': cached['metadata']}
+    cur.close()
+    if useconn is None and conn is not None:
+        conn.close()
+    _write_cache_file(cache_file, cached)
+    _memory[key] = dict(cached, frozen=_freeze(cached['metadata']))
+    return _memory[key]['frozen']
+
+# Remove the cached metadata of the database in `params`, or of all databases if `params` is None. The next call to `load_metadata` will query the database.
+def invalidate(params=None, cache_file=default_cache_file):
+    cache_file = Path(cache_file)
+    if params is not None:
+        paths = [_cache_path(params, cache_file)]
+    else:
+        paths = list(cache_file.parent.glob('%s-*%s' % (cache_file.stem, cache_file.suffix)))
+        paths.extend(Path(key) for key in _memory if Path(key).parent == cache_file.parent and Path(key).name.startswith(cache_file.stem + '-'))
+    for path in paths:
+        _memory.pop(str(path), None)
+        path.unlink(missing_ok=True)
+
+# Shortcuts for the values used by the importers
+def vocabulary(params, typname, **kwargs):
+    return load_metadata(params, **kwargs)['vocabularies'].get(typname, frozenset())
+
+def vocabulary_description(params, typname, **kwargs):
+    return load_metadata(params, **kwargs)['vocabulary_descriptions'].get(typname)
+
+def trait_info(params, **kwargs):
+    return load_metadata(params, **kwargs)['trait_info']
+
+# Site labels are read from the database on every call, so that sites inserted earlier in the session are included
+def site_labels(params, useconn=None):
+    if useconn is None:
+        conn = psycopg2.connect(**params)
+    else:
+        conn = useconn
+    cur = conn.cursor()
+    cur.execute("SELECT DISTINCT site_label FROM form.field_site")
+    labels = frozenset(row[0] for row in cur.fetchall())
+    cur.close()
+    if useconn is None and conn is not None:
+        conn.close()
+    return labels
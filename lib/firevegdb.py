@@ -2,15 +2,26 @@
 import psycopg2
 from psycopg2.extras import DictCursor
 from psycopg2.extensions import AsIs
+from lib.statementlog import traced_execute
+
+# SQL expression for point geometries given as (x, y, srid) tuples
+GEOM_TEMPLATE = "ST_SetSRID(ST_MakePoint(%s,%s),%s)"
+
+## adapt a geometry value for inclusion in a query, (x, y, srid) tuples are sent as typed parameters, strings are passed through as SQL expressions
+def geom_value(geom, cur):
+    if isinstance(geom, str):
+        return AsIs(geom)
+    return AsIs(cur.mogrify(GEOM_TEMPLATE, tuple(geom)).decode('utf-8'))
 
 ## shortcut for running simple database queries
+# Statements in dbquery, batch_upsert, bulk_upsert and batch_update are logged when tracing is enabled (see module `statementlog`)
 def dbquery(query,dbparams, useconn=None):
     if useconn is None:
         conn = psycopg2.connect(**dbparams)
     else:
         conn = useconn
     cur = conn.cursor(cursor_factory=DictCursor)
-    cur.execute(query)
+    traced_execute(cur, query)
     res = cur.fetchall()
     cur.close()
     if useconn is None and conn is not None:
@@ -30,9 +41,7 @@ def batch_upsert(params,table,records,keycol,idx, execute=False, useconn=None):
 
     for record in records:
         if len(record.keys())>len(keycol):
-            if 'geom' in record.keys():
-                the_geom=record['geom']
-                record['geom']='GEOMSTR'
+            values = [geom_value(v, cur) if k == 'geom' else v for k, v in record.items()]
             if idx is not None:
                 qrystr = "INSERT INTO %s (%s) values %s ON CONFLICT ON CONSTRAINT %s DO UPDATE SET %s"
                 upd=list()
@@ -41,7 +50,7 @@ def batch_upsert(params,table,records,keycol,idx, execute=False, useconn=None):
                         upd.append("{col}=EXCLUDED.{col}".format(col=k))
                 qry = cur.mogrify(qrystr, (AsIs(table),
                                 AsIs(','.join(record.keys())),
-                                tuple(record.values()),
+                                tuple(values),
                                 AsIs(idx),
                                 AsIs(','.join(upd))
                                ))
@@ -49,21 +58,20 @@ def batch_upsert(params,table,records,keycol,idx, execute=False, useconn=None):
                 qrystr = "INSERT INTO %s (%s) values %s ON CONFLICT DO NOTHING"
                 qry = cur.mogrify(qrystr, (AsIs(table),
                                 AsIs(','.join(record.keys())),
-                                tuple(record.values())
+                                tuple(values)
                                ))
 
-            if 'geom' in record.keys():
-                qry=qry.decode('utf-8')
-                qry=qry.replace("'GEOMSTR'",the_geom)
-                record['geom']=the_geom
-
             if execute:
-                cur.execute(qry)
+                traced_execute(cur, qry)
                 if cur.rowcount > 0:
                     updated_rows = updated_rows + cur.rowcount
             else:
                 print(qry)
-            
+
+    if execute and table.startswith('litrev.'):
+        # summaries of the species and traits written need to be recomputed (module `traitsummary`)
+        from lib.traitsummary import mark_dirty
+        mark_dirty(cur, table, records)
     conn.commit()        
     cur.close()
     print("%s rows updated" % (updated_rows))
@@ -72,6 +80,174 @@ def batch_upsert(params,table,records,keycol,idx, execute=False, useconn=None):
         conn.close()
         print('Database connection closed.')
 
+## Group records by their set of columns
+# `records` is a list of dictionaries or a RecordBatch (module `recordbatch`). Returns a dictionary with (columns, geometry type) as key and a list of row tuples as value, records with only key columns are ignored.
+def record_groups(records, keycol):
+    groups=dict()
+    if hasattr(records, 'column_groups'):
+        for cols, indices in records.column_groups().items():
+            if len(cols)>len(keycol):
+                for row in records.rows(cols, indices):
+                    geomtype = isinstance(row[cols.index('geom')], str) if 'geom' in cols else None
+                    groups.setdefault((cols, geomtype), list()).append(row)
+    else:
+        for record in records:
+            if len(record.keys())>len(keycol):
+                cols=tuple(record.keys())
+                geomtype = isinstance(record['geom'], str) if 'geom' in record else None
+                groups.setdefault((cols, geomtype), list()).append(tuple(record.values()))
+    return groups
+
+## Batch update or insert with multi-row statements
+# Records are grouped by their set of columns and sent in pages of `page_size` rows per INSERT statement. Point geometries given as (x, y, srid) tuples are sent as typed parameters, so site records are batched the same way as any other table. `records` can be a list of dictionaries or a RecordBatch.
+def bulk_upsert(params,table,records,keycol,idx, execute=False, useconn=None, page_size=500):
+    if useconn is None:
+        # connect to the PostgreSQL server
+        print('Connecting to the PostgreSQL database...')
+        conn = psycopg2.connect(**params)
+    else:
+        conn = useconn
+    cur = conn.cursor()
+    updated_rows=0
+
+    for (cols, geomtype), rows in record_groups(records, keycol).items():
+        if idx is not None:
+            # a single statement can not update the same row twice, keep the last record for each key
+            keypos=[cols.index(k) for k in keycol]
+            unique_rows=dict()
+            for row in rows:
+                unique_rows[tuple(row[i] for i in keypos)]=row
+            rows=list(unique_rows.values())
+            upd=["{col}=EXCLUDED.{col}".format(col=k) for k in cols if k not in keycol]
+            tail=cur.mogrify(" ON CONFLICT ON CONSTRAINT %s DO UPDATE SET %s", (AsIs(idx), AsIs(','.join(upd))))
+        else:
+            tail=b" ON CONFLICT DO NOTHING"
+        template="(%s)" % ','.join(GEOM_TEMPLATE if k == 'geom' and geomtype is False else '%s' for k in cols)
+        head=cur.mogrify("INSERT INTO %s (%s) VALUES ", (AsIs(table), AsIs(','.join(cols))))
+
+        for start in range(0, len(rows), page_size):
+            values=list()
+            for row in rows[start:start+page_size]:
+                params_row=list()
+                for k, v in zip(cols, row):
+                    if k == 'geom' and geomtype is False:
+                        params_row.extend(v)
+                    elif k == 'geom':
+                        params_row.append(AsIs(v))
+                    else:
+                        params_row.append(v)
+                values.append(cur.mogrify(template, params_row))
+            qry = head + b",".join(values) + tail
+            if execute:
+                traced_execute(cur, qry)
+                if cur.rowcount > 0:
+                    updated_rows = updated_rows + cur.rowcount
+            else:
+                print(qry)
+
+    if execute and table.startswith('litrev.'):
+        # summaries of the species and traits written need to be recomputed (module `traitsummary`)
+        from lib.traitsummary import mark_dirty
+        mark_dirty(cur, table, records)
+    conn.commit()
+    cur.close()
+    print("%s rows updated" % (updated_rows))
+
+    if useconn is None and conn is not None:
+        conn.close()
+        print('Database connection closed.')
+    return updated_rows
+
+## Insert a RecordBatch with COPY
+# Plain inserts without conflict handling, use this for new tables or staging tables. Rows are copied in one COPY statement per set of columns present.
+def copy_batch(params, table, batch, execute=False, useconn=None):
+    if useconn is None:
+        # connect to the PostgreSQL server
+        print('Connecting to the PostgreSQL database...')
+        conn = psycopg2.connect(**params)
+    else:
+        conn = useconn
+    cur = conn.cursor()
+    copied_rows=0
+    for cols, indices in batch.column_groups().items():
+        qry = "COPY %s (%s) FROM STDIN" % (table, ','.join(cols))
+        if execute:
+            cur.copy_expert(qry, batch.to_copy(cols, indices))
+            copied_rows = copied_rows + len(indices)
+        else:
+            print(qry)
+    conn.commit()
+    cur.close()
+    print("%s rows copied" % (copied_rows))
+    if useconn is None and conn is not None:
+        conn.close()
+        print('Database connection closed.')
+    return copied_rows
+
+def column_types(cur, table):
+    cur.execute("SELECT attname, format_type(atttypid, atttypmod) FROM pg_attribute WHERE attrelid = %s::regclass AND attnum > 0 AND NOT attisdropped", (table,))
+    return dict(cur.fetchall())
+
+## Keyed updates in one statement per batch
+# Applies the values in `rows` (a list of dictionaries with the key columns and the columns to set) with UPDATE ... FROM (VALUES ...), in pages of `page_size` rows. Rows are grouped by their set of columns (as in `bulk_upsert`) and each group has its own statement, so a row only sets the columns it has. By default rows are matched with `t.key = v.key` (t is the target table and v the values), `match` can give another condition for a key, e.g. `{'comment': "v.comment = ANY(t.comments)"}` or `{'observer': "t.observerlist[1] = v.observer"}`. With `only_null=True` only columns that are NULL are updated, `where` adds any other condition. Values are cast to the type of the column they are compared to or assigned to. Statements are run with `traced_execute`. Returns a dictionary with the number of rows updated for each key (a tuple of key values if there are several key columns).
+def batch_update(params, table, key_cols, rows, match=None, only_null=False, where=None, execute=False, useconn=None, page_size=1000):
+    if useconn is None:
+        # connect to the PostgreSQL server
+        print('Connecting to the PostgreSQL database...')
+        conn = psycopg2.connect(**params)
+    else:
+        conn = useconn
+    cur = conn.cursor()
+    match = dict(match or {})
+    types = column_types(cur, table)
+
+    counts = dict()
+    groups = dict()
+    for row in rows:
+        missing = [k for k in key_cols if k not in row]
+        if len(missing) > 0:
+            raise ValueError("row without key columns %s: %s" % (missing, row))
+        counts[row[key_cols[0]] if len(key_cols) == 1 else tuple(row[k] for k in key_cols)] = 0
+        set_cols = tuple(k for k in row.keys() if k not in key_cols)
+        if len(set_cols) > 0:
+            groups.setdefault(set_cols, list()).append(row)
+
+    for set_cols, group in groups.items():
+        cols = list(key_cols) + list(set_cols)
+        casts = list()
+        for k in cols:
+            coltype = types.get(k)
+            if coltype is not None and k in match and coltype.endswith('[]'):
+                # keys matched against an array column with ANY are cast to the element type
+                coltype = coltype[:-2]
+            casts.append("%s::" + coltype if coltype is not None else "%s")
+        template = "(%s)" % ','.join(casts)
+        conditions = [match.get(k, "t.{col} = v.{col}").format(col=k) for k in key_cols]
+        if only_null:
+            conditions.extend("t.%s IS NULL" % k for k in set_cols)
+        if where is not None:
+            conditions.append(where)
+        head = "UPDATE %s t SET %s FROM (VALUES " % (table, ','.join("%s=v.%s" % (k, k) for k in set_cols))
+        tail = ") AS v(%s) WHERE %s RETURNING %s" % (','.join(cols), ' AND '.join(conditions), ','.join("v.%s" % k for k in key_cols))
+        values = [tuple(row[k] for k in cols) for row in group]
+        if not execute:
+            print(head + "%s" + tail)
+            print("%s rows of values" % len(values))
+            continue
+        for start in range(0, len(values), page_size):
+            qry = head.encode('utf-8') + b",".join(cur.mogrify(template, v) for v in values[start:start+page_size]) + tail.encode('utf-8')
+            traced_execute(cur, qry)
+            for res in cur.fetchall():
+                key = res[0] if len(key_cols) == 1 else tuple(res)
+                counts[key] = counts.get(key, 0) + 1
+    conn.commit()
+    cur.close()
+    print("%s rows updated" % sum(counts.values()))
+    if useconn is None and conn is not None:
+        conn.close()
+        print('Database connection closed.')
+    return counts
+
 ### This function filters a list of `records` to find unique records and then validate them against the information in table `field_visit` (visit_id, visit_date and replicate_nr). Any valid but missing records are inserted in table `field_visit` and the samples are inserted in table `field_sample`.
 def validate_and_update_site_records(records,params, useconn=None):
     if useconn is None:
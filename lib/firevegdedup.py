@@ -0,0 +1,200 @@
+import hashlib
+import json
+from decimal import Decimal
+import psycopg2
+from psycopg2.extras import execute_values
+from psycopg2.extensions import AsIs
+from lib.firevegdb import bulk_upsert
+
+## Content hashes for literature trait records
+# Records in the litrev tables have a surrogate `record_id` and are inserted with `ON CONFLICT DO NOTHING`, so running an import twice inserts the same records again. The content hash is computed from the columns that define a record (species, raw and normalised values, main source and original sources) and stored in the indexed column `content_hash`. `dedup_upsert` skips records whose hash is already in the table, and `collapse_duplicates` removes existing duplicates. Hashes are always computed in Python, including for existing rows, so that both sides use the same canonical form.
+
+# species_code is not part of the hash, because codes are filled in later by the reconciliation with BioNet
+hash_columns = ('species', 'raw_value', 'norm_value', 'best', 'lower', 'upper', 'main_source', 'original_sources')
+
+# Canonical form of a value: numbers (including numeric strings) as floats, so that 12, '12' and Decimal('12.0') give the same hash
+def _canonical(value):
+    if isinstance(value, bool) or value is None:
+        return value
+    if isinstance(value, (int, float, Decimal)):
+        return float(value)
+    if isinstance(value, str):
+        value = value.strip()
+        try:
+            return float(value)
+        except ValueError:
+            return value
+    if isinstance(value, (list, tuple)):
+        return [_canonical(v) for v in value]
+    return str(value)
+
+def record_hash(record):
+    content = [_canonical(record.get(col)) for col in hash_columns]
+    return hashlib.sha1(json.dumps(content, separators=(',', ':')).encode('utf-8')).hexdigest()
+
+def _index_name(table):
+    return "%s_content_hash_idx" % table.split('.')[-1]
+
+# Add the content hash column and its index if they are not there yet. ALTER TABLE locks the table even with IF NOT EXISTS, so it is only run when the column is missing.
+def add_hash_column(cur, table):
+    if _has_hash_column(cur, table):
+        return
+    cur.execute("ALTER TABLE %s ADD COLUMN IF NOT EXISTS content_hash text", (AsIs(table),))
+    cur.execute("CREATE INDEX IF NOT EXISTS %s ON %s (content_hash)", (AsIs(_index_name(table)), AsIs(table)))
+
+def table_hash_columns(cur, table):
+    schema, name = table.split('.')
+    cur.execute("SELECT column_name FROM information_schema.columns WHERE table_schema=%s AND table_name=%s", (schema, name))
+    available = set(row[0] for row in cur.fetchall())
+    return [col for col in hash_columns if col in available]
+
+## Compute the content hash of existing rows without one
+# Rows are read with a server-side cursor and hashes are written back with UPDATE ... FROM (VALUES ...) in pages of `page_size` rows. Returns the number of rows updated.
+def backfill_hashes(params, table, execute=False, useconn=None, page_size=5000):
+    if useconn is None:
+        # connect to the PostgreSQL server
+        print('Connecting to the PostgreSQL database...')
+        conn = psycopg2.connect(**params)
+    else:
+        conn = useconn
+    cur = conn.cursor()
+    add_hash_column(cur, table)
+    cols = table_hash_columns(cur, table)
+    reader = conn.cursor(name='backfill_content_hash')
+    reader.itersize = page_size
+    reader.execute("SELECT record_id, %s FROM %s WHERE content_hash IS NULL", (AsIs(','.join(cols)), AsIs(table)))
+    qry = cur.mogrify("UPDATE %s t SET content_hash = v.content_hash FROM (VALUES %%s) AS v(record_id, content_hash) WHERE t.record_id = v.record_id",
+                      (AsIs(table),)).decode('utf-8')
+    updated_rows = 0
+    while True:
+        rows = reader.fetchmany(page_size)
+        if len(rows) == 0:
+            break
+        values = [(row[0], record_hash(dict(zip(cols, row[1:])))) for row in rows]
+        if execute:
+            execute_values(cur, qry, values, page_size=page_size)
+            updated_rows = updated_rows + cur.rowcount
+    reader.close()
+    if execute:
+        conn.commit()
+    else:
+        conn.rollback()
+    cur.close()
+    print("%s: content hash added to %s rows" % (table, updated_rows))
+    if useconn is None and conn is not None:
+        conn.close()
+        print('Database connection closed.')
+    return updated_rows
+
+def _has_hash_column(cur, table):
+    schema, name = table.split('.')
+    cur.execute("SELECT 1 FROM information_schema.columns WHERE table_schema=%s AND table_name=%s AND column_name='content_hash'",
+                (schema, name))
+    return cur.fetchone() is not None
+
+# Content hash of the rows without a stored hash (all rows if the table has no hash column yet), computed in Python and read with a server-side cursor
+def computed_hashes(conn, table, page_size=5000):
+    cur = conn.cursor()
+    cols = table_hash_columns(cur, table)
+    where = "WHERE content_hash IS NULL" if _has_hash_column(cur, table) else ""
+    cur.close()
+    reader = conn.cursor(name='computed_content_hash')
+    reader.itersize = page_size
+    reader.execute("SELECT record_id, %s FROM %s %s", (AsIs(','.join(cols)), AsIs(table), AsIs(where)))
+    hashes = [(row[0], record_hash(dict(zip(cols, row[1:])))) for row in reader]
+    reader.close()
+    return hashes
+
+# Hashes from `hashes` that are already in the table, looked up in the indexed `content_hash` column in pages. Rows without a stored hash are not seen, run `backfill_hashes` once before an import, or pass the hashes of those rows in `computed` (from `computed_hashes`, e.g. in dry runs).
+def existing_hashes(conn, table, hashes, page_size=5000, computed=None):
+    hashes = set(hashes)
+    cur = conn.cursor()
+    found = set(h for h in (computed or ()) if h in hashes)
+    if _has_hash_column(cur, table):
+        hashes = list(hashes)
+        for start in range(0, len(hashes), page_size):
+            cur.execute("SELECT DISTINCT content_hash FROM %s WHERE content_hash = ANY(%s)",
+                        (AsIs(table), hashes[start:start+page_size]))
+            found.update(row[0] for row in cur.fetchall())
+    cur.close()
+    return found
+
+## Insert records that are not in the table yet
+# Each record gets its content hash, duplicates within `records` and records with a hash already in the table are skipped, and the rest are inserted with `bulk_upsert`. Existing records are found with the index on `content_hash`. With `backfill=True` rows of the table without hash (from older imports or other loaders) are hashed first, and in a dry run their hashes are only computed. Imports that call this function for many chunks should run `backfill_hashes` once and use `backfill=False`, as `checkpoints.checkpointed_upsert` does, so that the table is not scanned and nothing is committed before the records of each chunk. Returns a summary with the number of records inserted and skipped.
+def dedup_upsert(params, table, records, execute=False, useconn=None, page_size=500, backfill=True):
+    if useconn is None:
+        # connect to the PostgreSQL server
+        print('Connecting to the PostgreSQL database...')
+        conn = psycopg2.connect(**params)
+    else:
+        conn = useconn
+    computed = None
+    if backfill and execute:
+        backfill_hashes(params, table, execute=True, useconn=conn)
+    elif backfill:
+        computed = [h for record_id, h in computed_hashes(conn, table)]
+    unique_records = dict()
+    for record in records:
+        content_hash = record_hash(record)
+        if content_hash not in unique_records:
+            unique_records[content_hash] = dict(record, content_hash=content_hash)
+    found = existing_hashes(conn, table, unique_records.keys(), computed=computed)
+    new_records = [record for content_hash, record in unique_records.items() if content_hash not in found]
+    summary = {'records': len(records), 'duplicated_in_batch': len(records) - len(unique_records),
+               'already_in_table': len(found), 'updated_rows': 0}
+    if len(new_records) > 0:
+        summary['updated_rows'] = bulk_upsert(params, table, new_records, keycol=['content_hash',], idx=None,
+                                              execute=execute, useconn=conn, page_size=page_size)
+    print("%s: %s records, %s duplicated in batch, %s already in table" % (
+        table, summary['records'], summary['duplicated_in_batch'], summary['already_in_table']))
+    if useconn is None and conn is not None:
+        conn.close()
+        print('Database connection closed.')
+    return summary
+
+## Groups of duplicated rows in a table
+# Read-only: hashes are computed in Python for all rows, so the report does not depend on the stored hashes. Returns the list of (content_hash, record_id kept, record_ids) for each group.
+def table_duplicates(conn, table, page_size=5000):
+    cur = conn.cursor()
+    cols = table_hash_columns(cur, table)
+    cur.close()
+    reader = conn.cursor(name='duplicated_content_hash')
+    reader.itersize = page_size
+    reader.execute("SELECT record_id, %s FROM %s", (AsIs(','.join(cols)), AsIs(table)))
+    groups = dict()
+    for row in reader:
+        groups.setdefault(record_hash(dict(zip(cols, row[1:]))), list()).append(row[0])
+    reader.close()
+    return [(h, min(ids), sorted(ids)) for h, ids in groups.items() if len(ids) > 1]
+
+## Find and remove duplicated records in a litrev table
+# For each group of rows with the same content the row with the lowest record_id is kept and the others are deleted. With `execute=False` the duplicates are only reported and nothing is written; with `execute=True` hashes are first added to rows without one. Returns the list of (content_hash, record_id kept, record_ids) for each group.
+def collapse_duplicates(params, table, execute=False, useconn=None):
+    if useconn is None:
+        # connect to the PostgreSQL server
+        print('Connecting to the PostgreSQL database...')
+        conn = psycopg2.connect(**params)
+    else:
+        conn = useconn
+    groups = table_duplicates(conn, table)
+    ndeleted = sum(len(ids) - 1 for h, keep, ids in groups)
+    if execute and len(groups) > 0:
+        backfill_hashes(params, table, execute=True, useconn=conn)
+        cur = conn.cursor()
+        cur.execute("DELETE FROM %s t USING %s d WHERE t.content_hash = d.content_hash AND t.record_id > d.record_id RETURNING t.species_code, t.species",
+                    (AsIs(table), AsIs(table)))
+        deleted = cur.fetchall()
+        ndeleted = len(deleted)
+        # summaries of the species with deleted rows need to be recomputed (module `traitsummary`)
+        from lib.traitsummary import mark_dirty
+        mark_dirty(cur, table, [{'species_code': code, 'species': species} for code, species in deleted])
+        conn.commit()
+        cur.close()
+        print("%s: %s duplicated rows deleted in %s groups" % (table, ndeleted, len(groups)))
+    else:
+        conn.rollback()
+        print("%s: %s duplicated rows in %s groups" % (table, ndeleted, len(groups)))
+    if useconn is None and conn is not None:
+        conn.close()
+        print('Database connection closed.')
+    return groups
@@ -1,10 +1,9 @@
-import pandas as pd
-from IPython.display import display, Markdown
 from lib.firevegdb import dbquery
+from lib.firevegcache import vocabulary_description
 def show_trait_info(trait_name,trait_df,params):
-    # Check comments on vocabularies
-    qry_vocabulary = "SELECT pg_catalog.obj_description(t.oid, 'pg_type')::json from pg_type t where typname = '%s';" 
-
+    # pandas and display functions are only needed in notebooks
+    import pandas as pd
+    from IPython.display import display, Markdown
     # Number of records per source
     qry_source = 'SELECT main_source,count(*) FROM litrev.%s GROUP BY main_source'
     # Number of records per value of categorical variable
@@ -28,14 +27,15 @@ def show_trait_info(trait_name,trait_df,params):
     # display(elem.transpose())
     cat_vocab = elem.iloc[0]['category_vocabulary']
     if cat_vocab is not None:
-        cat_table = dbquery(qry_vocabulary % cat_vocab , params)
+        # comments on vocabularies are read from the local metadata cache
+        cat_table = vocabulary_description(params, cat_vocab)
         display(Markdown("##### Vocabulary for trait"))
-        display(pd.DataFrame(cat_table[0]).transpose())
+        display(pd.DataFrame((cat_table,)).transpose())
     met_vocab = elem.iloc[0]['method_vocabulary']
     if met_vocab is not None:
-        met_table = dbquery(qry_vocabulary % met_vocab,params)
+        met_table = vocabulary_description(params, met_vocab)
         display(Markdown("##### Vocabulary for the methods"))
-        display(pd.DataFrame(met_table[0]).transpose())
+        display(pd.DataFrame((met_table,)).transpose())
     display(Markdown("#### Summary of data"))
     if elem.iloc[0]['Value type'] == 'categorical':
         res = dbquery(qry_values % trait_name,params)
@@ -0,0 +1,309 @@
+import re
+from collections import Counter
+import psycopg2
+from psycopg2.extras import DictCursor, execute_values
+from psycopg2.extensions import AsIs
+from lib.traitsummary import mark_dirty_names
+
+# Tables with species names that should be matched to species codes in the BioNet taxonomic list
+field_species_tables = ('form.quadrat_samples',)
+
+## list of all the trait tables in the litrev schema
+def litrev_trait_tables(cur):
+    cur.execute("SELECT code FROM litrev.trait_info ORDER BY code")
+    return tuple('litrev.%s' % row[0] for row in cur.fetchall())
+
+# Classify the names without species code in `table`: names matching exactly one numeric species code in species.bionet are `matched`, names matching several codes are `ambiguous`, and the rest are `unmatched`
+qry_classify = """
+SELECT t.species, count(DISTINCT b."speciesCode_Synonym") AS ncodes
+FROM (SELECT DISTINCT species FROM %s WHERE species_code IS NULL AND species IS NOT NULL) t
+LEFT JOIN species.bionet b
+  ON b."scientificName" = t.species AND b."speciesCode_Synonym"::text ~ '^[0-9]+$'
+GROUP BY t.species
+ORDER BY t.species;
+"""
+
+# Update all rows of `table` with a unique match in one statement
+qry_update = """
+WITH candidates AS (
+  SELECT "scientificName" AS species, min("speciesCode_Synonym"::text) AS species_code
+  FROM species.bionet
+  WHERE "speciesCode_Synonym"::text ~ '^[0-9]+$'
+    AND "scientificName" IN (SELECT DISTINCT species FROM %s WHERE species_code IS NULL)
+  GROUP BY "scientificName"
+  HAVING count(DISTINCT "speciesCode_Synonym") = 1
+)
+UPDATE %s t SET species_code = c.species_code::int
+FROM candidates c
+WHERE t.species = c.species AND t.species_code IS NULL;
+"""
+
+## Reconcile species codes with the BioNet taxonomic list
+# Applies a set-based update to `form.quadrat_samples` and all litrev trait tables (or the list of `tables` given), and returns a report with the matched, ambiguous and unmatched names and the number of updated rows for each table.
+def reconcile_species_codes(params, tables=None, execute=False, useconn=None):
+    if useconn is None:
+        # connect to the PostgreSQL server
+        print('Connecting to the PostgreSQL database...')
+        conn = psycopg2.connect(**params)
+    else:
+        conn = useconn
+    cur = conn.cursor(cursor_factory=DictCursor)
+    if tables is None:
+        tables = field_species_tables + litrev_trait_tables(cur)
+
+    report = dict()
+    for table in tables:
+        cur.execute(qry_classify, (AsIs(table),))
+        result = {'matched': list(), 'ambiguous': list(), 'unmatched': list(), 'updated_rows': 0}
+        for row in cur.fetchall():
+            if row['ncodes'] == 1:
+                result['matched'].append(row['species'])
+            elif row['ncodes'] > 1:
+                result['ambiguous'].append(row['species'])
+            else:
+                result['unmatched'].append(row['species'])
+        if len(result['matched']) > 0:
+            qry = cur.mogrify(qry_update, (AsIs(table), AsIs(table)))
+            if execute:
+                cur.execute(qry)
+                result['updated_rows'] = cur.rowcount
+                if table.startswith('litrev.'):
+                    mark_dirty_names(cur, table, result['matched'])
+            else:
+                print(qry)
+        print("%s: %s names matched (%s rows updated), %s ambiguous, %s unmatched" %
+              (table, len(result['matched']), result['updated_rows'],
+               len(result['ambiguous']), len(result['unmatched'])))
+        report[table] = result
+
+    conn.commit()
+    cur.close()
+    if useconn is None and conn is not None:
+        conn.close()
+        print('Database connection closed.')
+    return report
+
+# Canonical taxon names
+# Names are reduced to genus, epithets and infraspecific ranks in lower case: authority strings are removed, whitespace and case are folded and the different spellings of ranks are unified (e.g. `ssp.`, `subsp` and `subspecies` are all written as `subsp.`). Phrase names (`Genus sp. Locality (Collector 123)`) are kept as they are after the `sp.`. Authorities are recognised by parentheses, periods (abbreviated names and initials), single capital letters and connecting words such as `ex` and `&`; a capitalised word is read as an epithet only where an epithet is expected (after the genus, a qualifier or a rank).
+
+rank_markers = {'subsp.': 'subsp.', 'subsp': 'subsp.', 'ssp.': 'subsp.', 'ssp': 'subsp.', 'subspecies': 'subsp.',
+                'var.': 'var.', 'var': 'var.', 'variety': 'var.', 'f.': 'f.', 'forma': 'f.'}
+name_qualifiers = ('aff.', 'cf.', 'x')
+author_words = ('ex', 'et', '&', 'de', 'der', 'den', 'van', 'von', 'da', 'du', 'la', 'le', 'in')
+re_epithet = re.compile(r"^[a-z][a-z\-]+$")
+re_initial = re.compile(r"^[A-Z]$")
+re_spaces = re.compile(r"\s+")
+
+def _is_author(tok):
+    return ('(' in tok or ')' in tok or '.' in tok or tok.lower() in author_words or
+            re_initial.match(tok) is not None)
+
+def _is_epithet(tok):
+    return not _is_author(tok) and re_epithet.match(tok.lower()) is not None
+
+def canonical_name(name):
+    if name is None:
+        return None
+    tokens = re_spaces.sub(" ", name.replace('\u00d7', ' x ')).strip(" ,;").split(" ")
+    if len(tokens) == 0 or tokens[0] == '':
+        return None
+    canonical = [tokens[0].lower()]
+    authority = False
+    expect_epithet = True
+    k = 1
+    while k < len(tokens):
+        tok = tokens[k].strip(",;")
+        low = tok.lower()
+        following = tokens[k+1].strip(",;") if k+1 < len(tokens) else ''
+        if low in ('sp.', 'sp') and not authority:
+            canonical.append('sp.')
+            canonical.extend(t.lower() for t in tokens[k+1:])
+            break
+        elif low in rank_markers and _is_epithet(following):
+            canonical.extend((rank_markers[low], following.lower()))
+            authority = False
+            expect_epithet = False
+            k = k + 1
+        elif low in name_qualifiers and not authority:
+            canonical.append(low)
+            expect_epithet = True
+        elif not authority and _is_epithet(tok) and (expect_epithet or tok == low):
+            canonical.append(low)
+            expect_epithet = False
+        else:
+            # anything else is part of the authority
+            authority = True
+        k = k + 1
+    return " ".join(canonical)
+
+def _trigrams(x):
+    x = "  %s " % x
+    return set(x[i:i+3] for i in range(len(x) - 2))
+
+# Edit distance between two strings, computed in a band of width `max_dist` around the diagonal; any distance above `max_dist` is returned as max_dist + 1
+def levenshtein(a, b, max_dist=None):
+    if len(a) < len(b):
+        a, b = b, a
+    if max_dist is None:
+        max_dist = len(a)
+    if len(a) - len(b) > max_dist:
+        return max_dist + 1
+    big = max_dist + 1
+    previous = list(range(len(b) + 1))
+    for i in range(1, len(a) + 1):
+        ca = a[i-1]
+        lo = max(1, i - max_dist)
+        hi = min(len(b), i + max_dist)
+        current = [big] * (len(b) + 1)
+        current[0] = i if i <= max_dist else big
+        for j in range(lo, hi + 1):
+            current[j] = min(previous[j] + 1, current[j-1] + 1, previous[j-1] + (ca != b[j-1]))
+        if min(current[lo-1:hi+1]) > max_dist:
+            return big
+        previous = current
+    return min(previous[-1], big)
+
+def similarity(a, b, min_score=0.0):
+    if a == b:
+        return 1.0
+    longest = max(len(a), len(b))
+    dist = levenshtein(a, b, int((1.0 - min_score) * longest))
+    return max(0.0, 1.0 - dist / longest)
+
+## In-memory index of taxon names for exact, canonical and fuzzy matching
+# Names are grouped by genus, fuzzy candidates are found with a trigram index within the genus (or the closest genus) and ranked by edit distance. Results are memoised, so repeated names are only resolved once.
+class TaxonNameIndex:
+    def __init__(self, names):
+        self.exact = dict()
+        self.canonical = dict()
+        self.genera = dict()
+        for name, code in names:
+            if name is None:
+                continue
+            self.exact.setdefault(name, set()).add(code)
+            canon = canonical_name(name)
+            if canon is not None:
+                self.canonical.setdefault(canon, dict()).setdefault(code, name)
+        for canon in self.canonical:
+            genus = canon.split(" ")[0]
+            self.genera.setdefault(genus, dict())
+            for gram in _trigrams(canon):
+                self.genera[genus].setdefault(gram, list()).append(canon)
+        self.genus_grams = dict()
+        for genus in self.genera:
+            for gram in _trigrams(genus):
+                self.genus_grams.setdefault(gram, list()).append(genus)
+        self._cache = dict()
+
+    # Build the index from the names and species codes in species.bionet
+    @classmethod
+    def from_bionet(cls, params, useconn=None):
+        if useconn is None:
+            conn = psycopg2.connect(**params)
+        else:
+            conn = useconn
+        cur = conn.cursor()
+        cur.execute("""SELECT "scientificName", "speciesCode_Synonym"::text FROM species.bionet WHERE "speciesCode_Synonym"::text ~ '^[0-9]+$'""")
+        index = cls(cur.fetchall())
+        cur.close()
+        if useconn is None and conn is not None:
+            conn.close()
+        return index
+
+    def _closest(self, query, postings, min_score=0.0, n=5):
+        grams = _trigrams(query)
+        counts = Counter()
+        for gram in grams:
+            counts.update(postings.get(gram, ()))
+        best = None
+        for candidate, shared in counts.most_common(n):
+            # each edit changes at most three trigrams, which gives a lower bound of the distance
+            bound = 1.0 - ((len(grams) - shared) / 3.0) / max(len(query), len(candidate))
+            if best is not None and bound <= best[1]:
+                continue
+            score = similarity(query, candidate, min_score if best is None else max(min_score, best[1]))
+            if best is None or score > best[1]:
+                best = (candidate, score)
+        return best
+
+    def _result(self, name, canon, score, method):
+        codes = self.canonical[canon]
+        result = {'name': name, 'score': round(score, 3), 'method': method}
+        if len(codes) == 1:
+            code, matched = next(iter(codes.items()))
+            result['matched_name'] = matched
+            result['species_code'] = code
+        else:
+            result['method'] = 'ambiguous'
+            result['matched_name'] = sorted(codes.values())
+        return result
+
+    # Match one name, returns a dictionary with the matched name, species code, score (1 for exact and canonical matches) and method, or None if there is no candidate with a score of at least `min_score`
+    def match(self, name, min_score=0.85):
+        if (name, min_score) in self._cache:
+            return self._cache[(name, min_score)]
+        result = None
+        if name in self.exact and len(self.exact[name]) == 1:
+            result = {'name': name, 'matched_name': name, 'species_code': next(iter(self.exact[name])),
+                      'score': 1.0, 'method': 'exact'}
+        else:
+            canon = canonical_name(name)
+            if canon in self.canonical:
+                result = self._result(name, canon, 1.0, 'canonical')
+            elif canon is not None:
+                genus = canon.split(" ")[0]
+                if genus not in self.genera:
+                    closest_genus = self._closest(genus, self.genus_grams, min_score)
+                    if closest_genus is not None:
+                        genus = closest_genus[0]
+                if genus in self.genera:
+                    best = self._closest(canon, self.genera[genus], min_score)
+                    if best is not None and best[1] >= min_score:
+                        result = self._result(name, best[0], best[1], 'fuzzy')
+        self._cache[(name, min_score)] = result
+        return result
+
+    # Match a list of names, returns a dictionary with the result for each distinct name
+    def match_many(self, names, min_score=0.85):
+        return {name: self.match(name, min_score) for name in set(names) if name is not None}
+
+## Fill missing species codes with the matches of a TaxonNameIndex
+# Names without species code in each table are resolved in bulk with `index`, matches with a score of at least `min_score` are written with one UPDATE ... FROM (VALUES ...) statement per table. Returns the list of matches applied for each table.
+def update_species_codes_from_index(params, index, tables=None, min_score=0.9, execute=False, useconn=None):
+    if useconn is None:
+        # connect to the PostgreSQL server
+        print('Connecting to the PostgreSQL database...')
+        conn = psycopg2.connect(**params)
+    else:
+        conn = useconn
+    cur = conn.cursor()
+    if tables is None:
+        tables = field_species_tables + litrev_trait_tables(cur)
+
+    report = dict()
+    for table in tables:
+        cur.execute("SELECT DISTINCT species FROM %s WHERE species_code IS NULL AND species IS NOT NULL", (AsIs(table),))
+        matches = index.match_many([row[0] for row in cur.fetchall()], min_score)
+        applied = [m for m in matches.values() if m is not None and 'species_code' in m]
+        updated_rows = 0
+        if len(applied) > 0:
+            qry = cur.mogrify("UPDATE %s t SET species_code = v.species_code::int FROM (VALUES %%s) AS v(species, species_code) WHERE t.species = v.species AND t.species_code IS NULL",
+                              (AsIs(table),)).decode('utf-8')
+            values = [(m['name'], m['species_code']) for m in applied]
+            if execute:
+                execute_values(cur, qry, values, page_size=len(values))
+                updated_rows = cur.rowcount
+                if table.startswith('litrev.'):
+                    mark_dirty_names(cur, table, [m['name'] for m in applied])
+            else:
+                print(qry)
+                print(values)
+        print("%s: %s of %s names matched, %s rows updated" % (table, len(applied), len(matches), updated_rows))
+        report[table] = applied
+
+    conn.commit()
+    cur.close()
+    if useconn is None and conn is not None:
+        conn.close()
+        print('Database connection closed.')
+    return report
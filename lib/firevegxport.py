@@ -1,6 +1,5 @@
-import pandas as pd
-
 def summarise_values(x,w):
+    import pandas as pd
     if None in x:
         sfx = " * "
     else:
@@ -23,6 +22,7 @@ def summarise_values(x,w):
     return (val + sfx).strip(" ")
 
 def summarise_triplet(x,y,z,w):
+    import pandas as pd
     df=pd.concat({"best": pd.Series(x),"lower": pd.Series(y),"upper": pd.Series(z),"weight": pd.Series(w)},axis=1)
     val="%0.1f (%0.1f -- %0.1f)" % (df['best'].mean(),df['lower'].min(),df['upper'].max())
     if val=="nan (nan -- nan)":
@@ -58,4 +58,164 @@ def extract_refs(row,slc):
         if type(x)==list:
             valid=valid+x
     z=list(set(valid))
-    return(z)
\ No newline at end of file
+    return(z)
+
+## Streaming export of trait and field data
+# Tables are read in batches through a server-side cursor and written as Parquet files partitioned by table (trait) and `main_source`, and as gzip CSV files written directly from `COPY ... TO STDOUT`. Postgres arrays are written as list columns in Parquet. A `manifest.json` file lists all files with their row counts and SHA-256 checksums.
+
+# Parquet types for Postgres types, other types are exported as strings
+arrow_types = {'int2': 'int64', 'int4': 'int64', 'int8': 'int64', 'float4': 'float64', 'float8': 'float64',
+               'numeric': 'float64', 'bool': 'bool', 'date': 'date32', 'timestamp': 'timestamp',
+               'timestamptz': 'timestamptz'}
+
+def list_export_tables(cur):
+    cur.execute("SELECT code FROM litrev.trait_info ORDER BY code")
+    tables = ['litrev.%s' % row[0] for row in cur.fetchall()]
+    cur.execute("SELECT table_name FROM information_schema.tables WHERE table_schema='form' AND table_type='BASE TABLE' ORDER BY table_name")
+    tables.extend('form.%s' % row[0] for row in cur.fetchall())
+    return tables
+
+# Columns of a table with their type name and whether they are arrays
+def table_columns(cur, table):
+    cur.execute("""SELECT a.attname, coalesce(e.typname, t.typname), t.typcategory = 'A',
+                          coalesce(e.typtype, t.typtype) = 'e'
+                   FROM pg_attribute a
+                   JOIN pg_type t ON a.atttypid = t.oid
+                   LEFT JOIN pg_type e ON t.typelem = e.oid AND t.typcategory = 'A'
+                   WHERE a.attrelid = %s::regclass AND a.attnum > 0 AND NOT a.attisdropped
+                   ORDER BY a.attnum""", (table,))
+    return cur.fetchall()
+
+# Select expressions for the export, types without a Parquet equivalent (enums, json, etc.) are cast to text and geometries are written as WKT
+def _select_list(columns):
+    exprs = list()
+    for name, typname, is_array, is_enum in columns:
+        if typname == 'geometry':
+            exprs.append('ST_AsText("%s") AS "%s"' % (name, name))
+        elif typname == 'numeric':
+            exprs.append('"%s"::float8%s AS "%s"' % (name, '[]' if is_array else '', name))
+        elif typname not in arrow_types:
+            exprs.append('"%s"::text%s AS "%s"' % (name, '[]' if is_array else '', name))
+        else:
+            exprs.append('"%s"' % name)
+    return ', '.join(exprs)
+
+def _arrow_schema(pa, columns):
+    fields = list()
+    for name, typname, is_array, is_enum in columns:
+        typ = arrow_types.get(typname, 'string')
+        if typ == 'date32':
+            arrow_type = pa.date32()
+        elif typ == 'timestamp':
+            arrow_type = pa.timestamp('us')
+        elif typ == 'timestamptz':
+            arrow_type = pa.timestamp('us', tz='UTC')
+        else:
+            arrow_type = pa.type_for_alias(typ)
+        if is_array:
+            arrow_type = pa.list_(arrow_type)
+        fields.append(pa.field(name, arrow_type))
+    return pa.schema(fields)
+
+def file_checksum(filename, blocksize=1024*1024):
+    import hashlib
+    digest = hashlib.sha256()
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(blocksize), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+def _partition_name(value):
+    from urllib.parse import quote
+    return quote(str(value), safe='-_.') if value is not None else '__null__'
+
+# Export one table to Parquet files, one file per value of `main_source` if the table has this column
+def export_table_parquet(conn, table, outdir, batch_size=10000):
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    cur = conn.cursor()
+    columns = table_columns(cur, table)
+    cur.close()
+    schema = _arrow_schema(pa, columns)
+    names = [col[0] for col in columns]
+    part = names.index('main_source') if 'main_source' in names else None
+    tabledir = outdir / ('table=%s' % table)
+    writers = dict()
+    nrows = dict()
+    cur = conn.cursor(name='export_%s' % table.replace('.', '_'))
+    cur.itersize = batch_size
+    cur.execute('SELECT %s FROM %s' % (_select_list(columns), table))
+    try:
+        while True:
+            rows = cur.fetchmany(batch_size)
+            if len(rows) == 0:
+                break
+            groups = dict()
+            for row in rows:
+                groups.setdefault(row[part] if part is not None else None, list()).append(row)
+            for key, group in groups.items():
+                if key not in writers:
+                    if part is not None:
+                        filename = tabledir / ('main_source=%s' % _partition_name(key)) / 'part-0.parquet'
+                    else:
+                        filename = tabledir / 'part-0.parquet'
+                    filename.parent.mkdir(parents=True, exist_ok=True)
+                    writers[key] = (filename, pq.ParquetWriter(str(filename), schema))
+                    nrows[key] = 0
+                data = {name: [row[i] for row in group] for i, name in enumerate(names)}
+                writers[key][1].write_table(pa.Table.from_pydict(data, schema=schema))
+                nrows[key] = nrows[key] + len(group)
+    finally:
+        cur.close()
+        for filename, writer in writers.values():
+            writer.close()
+    conn.commit()
+    return [{'table': table, 'format': 'parquet', 'main_source': key, 'path': str(filename.relative_to(outdir)),
+             'rows': nrows[key], 'sha256': file_checksum(filename)} for key, (filename, writer) in writers.items()]
+
+# Export one table to a gzip CSV file with COPY
+def export_table_csv(conn, table, outdir):
+    import gzip
+    filename = outdir / 'csv' / ('%s.csv.gz' % table)
+    filename.parent.mkdir(parents=True, exist_ok=True)
+    cur = conn.cursor()
+    columns = table_columns(cur, table)
+    with gzip.open(filename, 'wt', encoding='utf-8') as f:
+        cur.copy_expert('COPY (SELECT %s FROM %s) TO STDOUT WITH (FORMAT csv, HEADER)' % (_select_list(columns), table), f)
+    nrows = cur.rowcount
+    cur.close()
+    conn.commit()
+    return [{'table': table, 'format': 'csv', 'path': str(filename.relative_to(outdir)),
+             'rows': nrows, 'sha256': file_checksum(filename)}]
+
+## Export the litrev trait tables and the form tables to `outdir`
+def export_tables(params, outdir, tables=None, formats=('parquet', 'csv'), batch_size=10000, useconn=None):
+    import json
+    import psycopg2
+    from datetime import datetime
+    from pathlib import Path
+    outdir = Path(outdir)
+    outdir.mkdir(parents=True, exist_ok=True)
+    if useconn is None:
+        conn = psycopg2.connect(**params)
+    else:
+        conn = useconn
+    if tables is None:
+        cur = conn.cursor()
+        tables = list_export_tables(cur)
+        cur.close()
+    files = list()
+    try:
+        for table in tables:
+            if 'parquet' in formats:
+                files.extend(export_table_parquet(conn, table, outdir, batch_size))
+            if 'csv' in formats:
+                files.extend(export_table_csv(conn, table, outdir))
+            print("%s exported" % table)
+    finally:
+        if useconn is None and conn is not None:
+            conn.close()
+    manifest = {'created': datetime.now().isoformat(timespec='seconds'), 'files': files}
+    with open(outdir / 'manifest.json', 'w') as f:
+        json.dump(manifest, f, indent=1, default=str)
+    return manifest
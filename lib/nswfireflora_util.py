@@ -1,5 +1,6 @@
 import re
 import copy
+import functools
 r = re.compile("[A-Z][a-z]+")
 def create_ref_code(x):
     
@@ -61,76 +62,126 @@ def extract_link(target,ref1,ref2, ref3, ref4):
         else:
             return None
 
-def extract_value(target, switcher, varname, ref1, ref2, ref3, ref4,
-                  splitstring="&|;|,| or | and "):
-    assert (target.value is not None),"Only works whith non-empty cells"
-    assert isinstance(switcher,dict),"Switcher argument must be a dictionary"
-    assert isinstance(varname,str),"Variable name argument must be a string"
-    p=re.compile('[,;\s]+')
-    val = target.value
-    rslts = list()
+## Cached parsing of cell values
+# Cells in SpeciesData repeat the same text many times (e.g. "R", "S/R" or "yes (12, 34)"), so the text of each cell is parsed once per (text, switcher, split pattern) and the parsed structure is shared as tuples. Font notes, references and species are added to new records for each cell.
+re_refs = re.compile(r"\(([\w\d, ]+)\)")
+re_refsep = re.compile(r'[,;\s]+')
+re_refsuffix = re.compile("[abc]$")
+
+def _ref_tokens(w):
+    tokens = list()
+    for refs in re_refs.findall(w):
+        for ref in re_refsep.split(refs):
+            ref = re_refsuffix.sub("", ref.strip(" "))
+            tokens.append(int(ref) if ref.isnumeric() else ref)
+    return tuple(tokens)
+
+## Index of reference strings by refcode
+# Build the index once with `ref_index` and pass it as `index` to the record functions. Without `index` the index is built only for cells that cite references, from the content of the reference lists, and memoised, so lists with the same content share one index.
+def ref_index(ref2, ref3, ref4):
+    return _ref_index(_ref_pairs(ref2), _ref_pairs(ref3), _ref_pairs(ref4))
+
+def _ref_pairs(reflist):
+    return tuple((elem['refcode'], elem['refstring']) for elem in reflist)
+
+@functools.lru_cache(maxsize=8)
+def _ref_index(ref2, ref3, ref4):
+    # numeric refcodes are looked up in ref2, other refcodes in ref3 and ref4
+    index = dict()
+    for refcode, refstring in ref2:
+        if isinstance(refcode, (int, float)):
+            index.setdefault(refcode, list()).append(refstring)
+    for reflist in (ref3, ref4):
+        for refcode, refstring in reflist:
+            if isinstance(refcode, str):
+                index.setdefault(refcode, list()).append(refstring)
+    return index
+
+def _resolve_refs(tokens, index):
+    refstrings = list()
+    for token in tokens:
+        refstrings.extend(index.get(token, ()))
+    return refstrings
+
+def _font_notes(target):
     note = list()
     if target.font.color != None:
         note.append('Cell color index %s' % target.font.color.indexed)
     if target.font.strike != None:
         note.append('Cell text has strikethrough')
+    return note
+
+# Switchers are used as part of the cache key: compiled vocabularies are hashable, dictionaries are converted to a tuple of items
+def _switcher_key(switcher):
+    if isinstance(switcher, dict):
+        return tuple(switcher.items())
+    return switcher
+
+# Parse the text of a categorical cell, returns a tuple of (raw value, norm value, notes, reference tokens) for each record
+@functools.lru_cache(maxsize=None)
+def parse_categorical_text(val, switcher, splitstring):
+    if isinstance(switcher, tuple):
+        switcher = dict(switcher)
+    rslts = list()
+    uncertain = False
+    for w in val.split('/'):
+        method = None
+        w = w.strip(" ")
+        start = 0
+        end = len(w)
+        tokens = ()
+        if w.find("(") > 0:
+            tokens = _ref_tokens(w)
+            end = w.index("(")
+        if w.find("a-") == 0:
+            method = 'Inferred from plant morphology'
+            start = 2
+        if w.find("?") > 0:
+            # once a part is uncertain, all following parts of the cell are noted as uncertain
+            uncertain = True
+        sw = w[start:end].strip(" ").replace("?", "")
+        for sv in re.split(splitstring, sw):
+            sv = sv.strip(" ")
+            raw = (w,)
+            notes = ("uncertain",) if uncertain else ()
+            if sw != w:
+                raw = raw + ('->', sw)
+                notes = notes + ("original record split into multiple entries, prob. different sources",)
+            if sv != sw:
+                raw = raw + ('->', sv)
+                notes = notes + ("original record split into multiple entries separated by and/or",)
+            if method is not None:
+                notes = notes + (method,)
+            rslts.append((raw, switcher.get(sv, None), notes, tokens))
+    return tuple(rslts)
+
+def extract_value(target, switcher, varname, ref1, ref2, ref3, ref4,
+                  splitstring="&|;|,| or | and ", index=None):
+    assert (target.value is not None),"Only works whith non-empty cells"
+    assert hasattr(switcher,'get'),"Switcher argument must be a dictionary or a Vocabulary"
+    assert isinstance(varname,str),"Variable name argument must be a string"
+    val = target.value
+    rslts = list()
+    note = _font_notes(target)
     if isinstance(val,int) or isinstance(val,float):
         record={"raw_value":[varname,str(val)]}
         if len(note)>0:
-            record["original_notes"]=note                
+            record["original_notes"]=note
         rslts.append(record)
     else:
-        for w in val.split('/'):
-            transvalue=None
-            oref=list()
-            method=None
-            w=w.strip(" ")
-            start=0
-            end=len(w)
-            if w.find("(")>0:
-                for refs in re.findall("\(([\w\d, ]+)\)",w):
-                    for ref in p.split(refs):
-                        ref=ref.strip(" ")
-                        ref=re.sub("[abc]$","",ref)
-                        if ref.isnumeric():
-                            for elem in filter(lambda x: x['refcode'] == int(ref), ref2):
-                                oref.append(elem['refstring'])
-                        else:
-                            for elem in filter(lambda x: x['refcode'] == ref, ref3):
-                                oref.append(elem['refstring'])
-                            for elem in filter(lambda x: x['refcode'] == ref, ref4):
-                                oref.append(elem['refstring'])
-                end=w.index("(")
-            if w.find("a-")==0:
-                method='Inferred from plant morphology'
-                start=2
-            if w.find("?")>0:
-                note.append("uncertain")
-                
-                
-            sw=w[start:end].strip(" ").replace("?","")
-            
-            for sv in re.split(splitstring,sw):
-                newnote=copy.deepcopy(note)
-                sv=sv.strip(" ")
-                transvalue=switcher.get(sv, None)
-                record={"raw_value":[varname,w],"main_source":"NSWFFRDv2.1"}
-                if sw != w:
-                    record["raw_value"].extend(['->',sw])
-                    newnote.append("original record split into multiple entries, prob. different sources")
-                if sv != sw:
-                    record["raw_value"].extend(['->',sv])
-                    newnote.append("original record split into multiple entries separated by and/or")
-                if transvalue is not None:
-                    record["norm_value"]=transvalue
-                if method is not None:
-                    newnote.append(method)
-                    #record["method_of_estimation"]=method
-                if len(oref)>0:
-                    record["original_sources"]=oref                
-                if len(newnote)>0:
-                    record["original_notes"]=newnote                
-                rslts.append(record)
+        for raw, transvalue, notes, tokens in parse_categorical_text(val, _switcher_key(switcher), splitstring):
+            record={"raw_value":[varname, *raw],"main_source":"NSWFFRDv2.1"}
+            if transvalue is not None:
+                record["norm_value"]=transvalue
+            if len(tokens)>0 and index is None:
+                # the reference lists are only read for cells with references
+                index = ref_index(ref2, ref3, ref4)
+            oref = _resolve_refs(tokens, index)
+            if len(oref)>0:
+                record["original_sources"]=oref
+            if len(note)+len(notes)>0:
+                record["original_notes"]=note+list(notes)
+            rslts.append(record)
     return(rslts)
 
 def create_record(spreadsheet,target_col,row_index,switcher,
@@ -159,16 +210,45 @@ def create_record(spreadsheet,target_col,row_index,switcher,
                 records.append(record)
         return(records)
 
-def extract_numeric_value(target,varname,ref1,ref2,ref3,ref4):
+# Parse the text of a numeric cell, returns a tuple of (raw value, values, notes, reference tokens) for each record, where values is a tuple of (key, value) pairs for best, lower and upper. Reference tokens are None when the text has no references.
+@functools.lru_cache(maxsize=None)
+def parse_numeric_text(val):
+    rslts = list()
+    for w in val.split('/'):
+        w = w.strip(" ")
+        raw = w
+        notes = ()
+        if w.find("?") > 0:
+            notes = ("uncertain",)
+            w = w.replace("?", "")
+        end = len(w)
+        tokens = None
+        if w.find("(") > 0:
+            tokens = _ref_tokens(w)
+            end = w.index("(")
+        sw = w[0:end].strip(" ")
+        values = ()
+        if sw.isnumeric():
+            values = (("best", sw),)
+        elif sw.find("-") > 0:
+            parts = sw.split("-")
+            if parts[0].isnumeric():
+                values = values + (("lower", parts[0]),)
+            if parts[1].isnumeric():
+                values = values + (("upper", parts[1]),)
+        elif sw.find(">") == 0:
+            if sw[1:].isnumeric():
+                values = (("lower", sw[1:]),)
+        elif sw.find("<") == 0:
+            if sw[1:].isnumeric():
+                values = (("upper", sw[1:]),)
+        rslts.append((raw, values, notes, tokens))
+    return tuple(rslts)
+
+def extract_numeric_value(target,varname,ref1,ref2,ref3,ref4,index=None):
     assert (target.value is not None),"Only works whith non-empty cells"
-    p=re.compile('[,;\s]+')
     val = target.value
-    note = list()
-    if target.font.color != None:
-        note.append('Cell color index %s' % target.font.color.indexed)
-    if target.font.strike != None:
-        note.append('Cell text has strikethrough')
-  
+    note = _font_notes(target)
     rslts = list()
     if isinstance(val,int) or isinstance(val,float):
         record={"raw_value":[varname,str(val)],"best":val,"main_source":"NSWFFRDv2.1"}
@@ -176,57 +256,21 @@ def extract_numeric_value(target,varname,ref1,ref2,ref3,ref4):
             record["original_notes"]=note 
         rslts.append(record)
     else:
-        for w in val.split('/'):
-            newnote=copy.deepcopy(note)
-            w=w.strip(" ")
-            record={"raw_value":[varname,w],"main_source":"NSWFFRDv2.1"}
-            if w.find("?")>0:
-                newnote.append("uncertain")
-                w=w.replace("?","")
-            end=len(w)
-            if w.find("(")>0:
-                record["original_sources"]=list()
-                for refs in re.findall("\(([\w\d, ]+)\)",w):
-                    for ref in p.split(refs):
-                        ref=ref.strip(" ")
-                        ref=re.sub("[abc]$","",ref)
-                        if ref.isnumeric():
-                            for elem in filter(lambda x: x['refcode'] == int(ref), ref2):
-                                record["original_sources"].append(elem['refstring'])
-                        else:
-                            for elem in filter(lambda x: x['refcode'] == ref, ref3):
-                                record["original_sources"].append(elem['refstring'])
-                            for elem in filter(lambda x: x['refcode'] == ref, ref4):
-                                record["original_sources"].append(elem['refstring'])
-                end=w.index("(")
-            sw=w[0:end].strip(" ")
-            if sw.isnumeric():
-                record["best"]=sw
-            elif sw.find("-")>0:
-                val = sw.split("-")
-                if val[0].isnumeric():
-                    record["lower"]=val[0]
-                if val[1].isnumeric():
-                    record["upper"]=val[1]
-            elif sw.find(">")==0:
-                val=sw[1:]
-                if val.isnumeric():
-                    record["lower"]=val
-            elif sw.find("<")==0:
-                val=sw[1:]
-                if val.isnumeric():
-                    record["upper"]=val
-            else:
-                val=sw    
-            
-            if len(newnote)>0:
-                record["original_notes"]=newnote  
+        for raw, values, notes, tokens in parse_numeric_text(val):
+            record={"raw_value":[varname,raw],"main_source":"NSWFFRDv2.1"}
+            if tokens is not None:
+                if len(tokens)>0 and index is None:
+                    index = ref_index(ref2, ref3, ref4)
+                record["original_sources"]=_resolve_refs(tokens, index)
+            record.update(values)
+            if len(note)+len(notes)>0:
+                record["original_notes"]=note+list(notes)
             rslts.append(record)
     return(rslts)
 
 def create_numeric_record(spreadsheet,target_col,row_index,
                          ref1,ref2,ref3,ref4,
-                        sp_col='A',spcode_col='B'):
+                        sp_col='A',spcode_col='B',index=None):
     records = list()
     target=spreadsheet[target_col][row_index]
     if (target.hyperlink is not None):
@@ -238,7 +282,7 @@ def create_numeric_record(spreadsheet,target_col,row_index,
         spcode=spreadsheet[spcode_col][row_index].value
         varname=spreadsheet[target_col][1].value
         rec=extract_numeric_value(target,varname,
-                              ref1,ref2,ref3,ref4)
+                              ref1,ref2,ref3,ref4,index=index)
         for record in rec:
             record["main_source"]="NSWFFRDv2.1"
             record["species"]=spname
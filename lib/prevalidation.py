@@ -0,0 +1,190 @@
+import json
+from collections import Counter
+from datetime import datetime
+import psycopg2
+from lib.firevegcache import load_metadata
+
+## Pre-validation of records before they are sent to the database
+# The constraints of a table are read from the catalog: foreign keys (e.g. site labels, visit keys, species codes), enum columns and NOT NULL columns without default. The referenced keys of each foreign key are loaded once as sets of tuples and shared between tables, enum labels come from the metadata cache (module `firevegcache`). A batch of records is checked column by column against these sets, and invalid records are returned in a rejection list with the reasons, so that they never reach the database.
+
+qry_foreign_keys = """
+SELECT con.conname, con.confrelid::regclass::text,
+       array_agg(a.attname::text ORDER BY k.n), array_agg(af.attname::text ORDER BY k.n)
+FROM pg_constraint con
+CROSS JOIN LATERAL unnest(con.conkey, con.confkey) WITH ORDINALITY AS k(attnum, fattnum, n)
+JOIN pg_attribute a ON a.attrelid = con.conrelid AND a.attnum = k.attnum
+JOIN pg_attribute af ON af.attrelid = con.confrelid AND af.attnum = k.fattnum
+WHERE con.contype = 'f' AND con.conrelid = %s::regclass
+GROUP BY con.conname, con.confrelid;
+"""
+
+qry_enum_columns = """
+SELECT a.attname::text, et.typname::text, t.typelem <> 0
+FROM pg_attribute a
+JOIN pg_type t ON t.oid = a.atttypid
+JOIN pg_type et ON et.oid = CASE WHEN t.typelem <> 0 THEN t.typelem ELSE t.oid END
+WHERE a.attrelid = %s::regclass AND a.attnum > 0 AND NOT a.attisdropped AND et.typtype = 'e';
+"""
+
+qry_not_null = """
+SELECT a.attname::text
+FROM pg_attribute a
+LEFT JOIN pg_attrdef d ON d.adrelid = a.attrelid AND d.adnum = a.attnum
+WHERE a.attrelid = %s::regclass AND a.attnum > 0 AND NOT a.attisdropped
+  AND a.attnotnull AND d.adbin IS NULL AND a.attidentity = '';
+"""
+
+# Referenced keys loaded in this session, by (table, columns). `TableConstraints.load` reloads them by default, so that keys inserted earlier in the session (e.g. new sites and visits) are found.
+_key_sets = dict()
+
+def key_set(cur, table, columns, refresh=False):
+    key = (table, tuple(columns))
+    if refresh or key not in _key_sets:
+        cur.execute("SELECT DISTINCT %s FROM %s" % (','.join('"%s"' % c for c in columns), table))
+        _key_sets[key] = frozenset(tuple(row) for row in cur.fetchall())
+    return _key_sets[key]
+
+# Convert record values to the type of the values in the domain, e.g. species codes given as numeric strings or visit dates given as datetime
+def _coercer(domain, position):
+    sample = next((k[position] for k in domain if k[position] is not None), None)
+    if isinstance(sample, int) and not isinstance(sample, bool):
+        def coerce(value):
+            if isinstance(value, str) and value.strip().isnumeric():
+                return int(value)
+            return value
+        return coerce
+    if isinstance(sample, str):
+        def coerce(value):
+            if isinstance(value, int) and not isinstance(value, bool):
+                return str(value)
+            return value
+        return coerce
+    if sample is not None and not isinstance(sample, datetime) and hasattr(sample, 'isoformat'):
+        def coerce(value):
+            if isinstance(value, datetime):
+                return value.date()
+            return value
+        return coerce
+    return None
+
+def _column(records, name):
+    if hasattr(records, 'columns'):
+        # RecordBatch: use the stored column and the presence mask
+        if name not in records.columns:
+            return [None] * len(records)
+        column = records.columns[name]
+        mask = records.present[name]
+        return [column[i] if mask[i] else None for i in range(len(records))]
+    return [record.get(name) for record in records]
+
+class TableConstraints:
+    def __init__(self, table, foreign_keys, enums, not_null):
+        self.table = table
+        self.foreign_keys = foreign_keys
+        self.enums = enums
+        self.not_null = not_null
+
+    ## Load the constraints of `table` and the domains they refer to
+    # `extra_keys` adds checks that are not declared as foreign keys in the database, as a dictionary with a tuple of columns as key and (table, tuple of columns) as value, e.g. `{('species_code',): ('species.bionet', ('speciesCode_Synonym',))}`. With `refresh=False` the referenced keys loaded by a previous call in this session are reused.
+    @classmethod
+    def load(cls, params, table, extra_keys=None, refresh=True, useconn=None):
+        if useconn is None:
+            conn = psycopg2.connect(**params)
+        else:
+            conn = useconn
+        cur = conn.cursor()
+        cur.execute(qry_foreign_keys, (table,))
+        declared = [(name, reftable, tuple(cols), tuple(refcols)) for name, reftable, cols, refcols in cur.fetchall()]
+        for cols, (reftable, refcols) in (extra_keys or {}).items():
+            if not any(d[1:] == (reftable, tuple(cols), tuple(refcols)) for d in declared):
+                declared.append(('%s (not declared)' % ','.join(cols), reftable, tuple(cols), tuple(refcols)))
+        # each referenced table is read at most once per call
+        loaded = set()
+        foreign_keys = list()
+        for name, reftable, cols, refcols in declared:
+            foreign_keys.append((name, cols, key_set(cur, reftable, refcols, refresh and (reftable, refcols) not in loaded)))
+            loaded.add((reftable, refcols))
+        cur.execute(qry_enum_columns, (table,))
+        enum_columns = cur.fetchall()
+        cur.execute(qry_not_null, (table,))
+        not_null = [row[0] for row in cur.fetchall()]
+        cur.close()
+        vocabularies = load_metadata(params, useconn=conn)['vocabularies']
+        enums = [(col, typname, is_array, vocabularies.get(typname, frozenset())) for col, typname, is_array in enum_columns]
+        if useconn is None and conn is not None:
+            conn.close()
+        return cls(table, foreign_keys, enums, not_null)
+
+    ## Check a batch of records
+    # `records` is a list of dictionaries or a RecordBatch. Returns the list of valid records and a list of rejections, each with the record and the list of reasons.
+    def validate(self, records, required=None):
+        n = len(records)
+        reasons = [list() for i in range(n)]
+        columns = dict()
+        def column(name):
+            if name not in columns:
+                columns[name] = _column(records, name)
+            return columns[name]
+
+        for name in (required if required is not None else self.not_null):
+            for i, value in enumerate(column(name)):
+                if value is None:
+                    reasons[i].append("%s is missing" % name)
+
+        for conname, cols, domain in self.foreign_keys:
+            values = [column(c) for c in cols]
+            coercers = [_coercer(domain, k) for k in range(len(cols))]
+            for k, coerce in enumerate(coercers):
+                if coerce is not None:
+                    values[k] = [coerce(v) for v in values[k]]
+            for i, key in enumerate(zip(*values)):
+                # as in SQL, keys with missing values are not checked
+                if None not in key and key not in domain:
+                    reasons[i].append("%s=%s not found (%s)" % (','.join(cols), ','.join(str(v) for v in key), conname))
+
+        for col, typname, is_array, labels in self.enums:
+            for i, value in enumerate(column(col)):
+                if value is None:
+                    continue
+                invalid = [v for v in value if v is not None and v not in labels] if is_array else ([value] if value not in labels else [])
+                for v in invalid:
+                    reasons[i].append("%s: %s is not in %s" % (col, v, typname))
+
+        valid = list()
+        rejections = list()
+        for i, record in enumerate(records):
+            if len(reasons[i]) > 0:
+                rejections.append({'record': record, 'reasons': reasons[i]})
+            else:
+                valid.append(record)
+        return valid, rejections
+
+# Number of rejections for each reason (values are removed from the reasons, so similar problems are counted together)
+def rejection_summary(rejections):
+    summary = Counter()
+    for rejection in rejections:
+        for reason in rejection['reasons']:
+            if ' not found ' in reason:
+                reason = reason.split('=')[0] + ' not found'
+            elif ' is not in ' in reason:
+                reason = reason.split(':')[0] + ' not in vocabulary'
+            elif reason.endswith(' is not a number'):
+                reason = reason.split(':')[0] + ' not a number'
+            summary[reason] = summary[reason] + 1
+    return summary
+
+def write_rejections(rejections, filename):
+    with open(filename, 'w') as f:
+        for rejection in rejections:
+            f.write(json.dumps(rejection, default=str))
+            f.write('\n')
+
+## Validate records for `table` in one call
+# Returns the valid records and the rejections, and prints a summary of the reasons. Referenced keys are read again from the database unless `refresh=False`.
+def prevalidate(params, table, records, extra_keys=None, refresh=True, useconn=None):
+    constraints = TableConstraints.load(params, table, extra_keys=extra_keys, refresh=refresh, useconn=useconn)
+    valid, rejections = constraints.validate(records)
+    print("%s: %s valid records, %s rejected" % (table, len(valid), len(rejections)))
+    for reason, count in rejection_summary(rejections).most_common():
+        print("  %s: %s" % (reason, count))
+    return valid, rejections
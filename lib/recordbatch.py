@@ -0,0 +1,183 @@
+import io
+from array import array
+from datetime import date, datetime
+
+## Column-wise storage for database records
+# A RecordBatch stores the records created by the `create_..._record` functions column by column instead of one dictionary per record. Columns declared in `types` are stored in typed arrays (array type codes, e.g. 'q' for integers and 'd' for floats), other columns in lists. Lists used for Postgres array fields are stored as tuples and identical values are shared between rows. A presence mask per column keeps track of the optional columns present in each record, so that records can be converted back to dictionaries with the same keys.
+class RecordBatch:
+    def __init__(self, records=None, types=None):
+        self.types = dict(types or {})
+        self.columns = dict()
+        self.present = dict()
+        self._shared = dict()
+        self.nrows = 0
+        if records is not None:
+            self.extend(records)
+
+    def __len__(self):
+        return self.nrows
+
+    def _add_column(self, name):
+        typecode = self.types.get(name)
+        if typecode is not None:
+            self.columns[name] = array(typecode, bytes(array(typecode).itemsize * self.nrows))
+        else:
+            self.columns[name] = [None] * self.nrows
+        self.present[name] = bytearray(self.nrows)
+        self._shared[name] = dict()
+
+    def _store(self, name, value):
+        column = self.columns[name]
+        if isinstance(column, array):
+            try:
+                column.append(value)
+                return
+            except (TypeError, OverflowError):
+                # values that do not fit the declared type are kept in a plain list
+                column = self.columns[name] = column.tolist()
+        if isinstance(value, list):
+            value = tuple(value)
+        if isinstance(value, (str, tuple)):
+            try:
+                value = self._shared[name].setdefault(value, value)
+            except TypeError:
+                pass
+        column.append(value)
+
+    def append(self, record):
+        for name in record:
+            if name not in self.columns:
+                self._add_column(name)
+        for name, column in self.columns.items():
+            if name in record:
+                self._store(name, record[name])
+                self.present[name].append(1)
+            else:
+                if isinstance(column, array):
+                    column.append(0)
+                else:
+                    column.append(None)
+                self.present[name].append(0)
+        self.nrows = self.nrows + 1
+
+    ## Build a batch from whole columns
+    # `columns` is a dictionary of lists of the same length, None values are marked as not present. Columns without any value are left out.
+    @classmethod
+    def from_columns(cls, columns, types=None):
+        batch = cls(types=types)
+        columns = {name: list(values) for name, values in columns.items()}
+        nrows = set(len(values) for values in columns.values())
+        if len(nrows) > 1:
+            raise ValueError("columns have different lengths: %s" % sorted(nrows))
+        for name, values in columns.items():
+            if all(value is None for value in values):
+                continue
+            batch._add_column(name)
+            for value in values:
+                if value is None:
+                    batch.columns[name].append(0 if isinstance(batch.columns[name], array) else None)
+                    batch.present[name].append(0)
+                else:
+                    batch._store(name, value)
+                    batch.present[name].append(1)
+        batch.nrows = nrows.pop() if len(nrows) > 0 else 0
+        return batch
+
+    # Append the output of a record function: a single record, a list of records, or None
+    def extend(self, records):
+        if records is None:
+            return
+        if isinstance(records, dict):
+            self.append(records)
+            return
+        for record in records:
+            if record is not None:
+                self.append(record)
+
+    def _value(self, name, i):
+        value = self.columns[name][i]
+        if isinstance(value, tuple) and name != 'geom':
+            return list(value)
+        return value
+
+    def record(self, i):
+        return {name: self._value(name, i) for name in self.columns if self.present[name][i]}
+
+    def __iter__(self):
+        for i in range(self.nrows):
+            yield self.record(i)
+
+    ## Group rows by the set of columns present
+    # Returns a dictionary with a tuple of column names as key and the list of row indices as value
+    def column_groups(self):
+        groups = dict()
+        names = list(self.columns)
+        masks = [self.present[name] for name in names]
+        for i in range(self.nrows):
+            key = tuple(name for name, mask in zip(names, masks) if mask[i])
+            groups.setdefault(key, list()).append(i)
+        return groups
+
+    # Rows for the given columns and row indices, as tuples
+    def rows(self, columns, indices=None):
+        if indices is None:
+            indices = range(self.nrows)
+        return [tuple(self._value(name, i) for name in columns) for i in indices]
+
+    def to_dataframe(self):
+        import pandas as pd
+        data = dict()
+        for name, column in self.columns.items():
+            mask = self.present[name]
+            data[name] = [self._value(name, i) if mask[i] else None for i in range(self.nrows)]
+        return pd.DataFrame(data)
+
+    ## Text payload for `COPY table (columns) FROM STDIN`
+    # Missing values are written as NULL, lists as Postgres array literals.
+    def to_copy(self, columns=None, indices=None):
+        if columns is None:
+            columns = list(self.columns)
+        if indices is None:
+            indices = range(self.nrows)
+        buffer = io.StringIO()
+        for i in indices:
+            fields = list()
+            for name in columns:
+                if name in self.present and self.present[name][i]:
+                    fields.append(copy_text(self.columns[name][i]))
+                else:
+                    fields.append('\\N')
+            buffer.write('\t'.join(fields))
+            buffer.write('\n')
+        buffer.seek(0)
+        return buffer
+
+    ## Payload for a multi-row VALUES clause, built with the `mogrify` method of a psycopg2 cursor
+    def to_values(self, cur, columns, indices=None):
+        template = "(%s)" % ','.join(['%s'] * len(columns))
+        return b','.join(cur.mogrify(template, row) for row in self.rows(columns, indices))
+
+def _escape_copy(text):
+    return text.replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n').replace('\r', '\\r')
+
+def _array_element(value):
+    if value is None:
+        return 'NULL'
+    text = copy_text(value, escape=False)
+    return '"%s"' % text.replace('\\', '\\\\').replace('"', '\\"')
+
+# Text representation of a value in the COPY text format
+def copy_text(value, escape=True):
+    if value is None:
+        return '\\N'
+    if isinstance(value, bool):
+        text = 't' if value else 'f'
+    elif isinstance(value, (datetime, date)):
+        text = value.isoformat()
+    elif isinstance(value, (list, tuple)):
+        text = '{%s}' % ','.join(_array_element(v) for v in value)
+    else:
+        text = str(value)
+    if escape:
+        return _escape_copy(text)
+    return text
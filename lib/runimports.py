@@ -0,0 +1,134 @@
+## Run imports from field forms without a notebook
+# Imports are described in a YAML manifest, for example:
+#
+#   database:
+#     config: ../secrets/database.ini
+#     section: fireveg-db-v1.1
+#   inputdir: ../data/input-field-form
+#   imports:
+#     - name: Alpine bogs sites
+#       workbook: UNSW_VegFireResponse_AlpineBogs_reformat_Sep2021.xlsx
+#       worksheet: Site
+#       record_function: create_field_site_record
+#       col_dictionary: {site_label: 0, location_description: 10, utm_zone: 11, xs: [12], ys: [13]}
+#       table: form.field_site
+#       keycol: [site_label]
+#       idx: field_site_pkey
+#
+# `record_function` is applied to each row with `import_records_from_workbook`, use `reader` instead for functions that read a whole worksheet (e.g. `read_fire_intensity`). Function names refer to `lib.fireveg` unless given as `module:function`. Relative paths are resolved from the folder of the manifest file.
+#
+# Run from the root of the repository with:
+#
+#   python -m lib.runimports manifest.yml [--dry-run] [--only NAME ...]
+#
+# With `--dry-run` the workbooks are read and the records of each entry are summarised (number of records and sets of columns) without connecting to the database, so a manifest can be checked without database credentials.
+
+import argparse
+import importlib
+import sys
+import time
+from pathlib import Path
+
+def resolve_function(name, default_module='lib.fireveg'):
+    if ':' in name:
+        module, name = name.split(':', 1)
+    else:
+        module = default_module
+    return getattr(importlib.import_module(module), name)
+
+def read_manifest(filename):
+    import yaml
+    with open(filename) as f:
+        manifest = yaml.safe_load(f)
+    if 'imports' not in manifest:
+        raise Exception('No imports defined in manifest {0}'.format(filename))
+    return manifest
+
+def _path(value, basedir):
+    path = Path(value)
+    if not path.is_absolute():
+        path = basedir / path
+    return path
+
+# Read the records for one entry of the manifest
+def read_entry_records(entry, inputdir):
+    from lib.fireveg import import_records_from_workbook
+    kwargs = entry.get('kwargs', {})
+    if 'reader' in entry:
+        reader = resolve_function(entry['reader'])
+        return reader(inputdir, entry['workbook'], entry['worksheet'], entry['col_dictionary'], **kwargs)
+    create_record_function = resolve_function(entry['record_function'])
+    return import_records_from_workbook(inputdir, entry['workbook'], entry['worksheet'], entry['col_dictionary'],
+                                        create_record_function=create_record_function, **kwargs)
+
+# Sets of columns in the records of one entry, as printed in dry runs
+def column_sets(records):
+    sets = dict()
+    for record in records:
+        cols = tuple(record.keys())
+        sets[cols] = sets.get(cols, 0) + 1
+    return sets
+
+def run_manifest(filename, execute=True, only=None, page_size=500):
+    filename = Path(filename)
+    basedir = filename.resolve().parent
+    manifest = read_manifest(filename)
+    inputdir = _path(manifest.get('inputdir', '.'), basedir)
+    if not execute:
+        return check_manifest(manifest, inputdir, only)
+
+    from lib.parseparams import read_dbparams
+    from lib.firevegdb import bulk_upsert
+    import psycopg2
+    dbconfig = manifest.get('database', {})
+    dbparams = read_dbparams(_path(dbconfig.get('config', 'secrets/database.ini'), basedir),
+                             section=dbconfig.get('section', 'postgresql'))
+    conn = psycopg2.connect(**dbparams)
+    summary = list()
+    try:
+        for entry in manifest['imports']:
+            name = entry.get('name', '%s/%s' % (entry['workbook'], entry['worksheet']))
+            if only is not None and name not in only:
+                continue
+            start = time.perf_counter()
+            print("%s: reading %s [%s]" % (name, entry['workbook'], entry['worksheet']))
+            records = read_entry_records(entry, inputdir)
+            updated_rows = bulk_upsert(dbparams, entry['table'], records,
+                                       keycol=tuple(entry.get('keycol', ())), idx=entry.get('idx'),
+                                       execute=execute, useconn=conn, page_size=page_size)
+            summary.append((name, len(records), updated_rows, time.perf_counter() - start))
+    finally:
+        conn.close()
+    for name, nrecords, updated_rows, elapsed in summary:
+        print("%s: %s records, %s rows updated in %0.1f s" % (name, nrecords, updated_rows, elapsed))
+    return summary
+
+# Read the records of each entry without a database connection, returns the same summary as `run_manifest` with no rows updated
+def check_manifest(manifest, inputdir, only=None):
+    summary = list()
+    for entry in manifest['imports']:
+        name = entry.get('name', '%s/%s' % (entry['workbook'], entry['worksheet']))
+        if only is not None and name not in only:
+            continue
+        start = time.perf_counter()
+        print("%s: reading %s [%s]" % (name, entry['workbook'], entry['worksheet']))
+        records = read_entry_records(entry, inputdir)
+        for cols, nrecords in column_sets(records).items():
+            print("  %s: %s records with columns %s" % (entry['table'], nrecords, ','.join(cols)))
+        summary.append((name, len(records), 0, time.perf_counter() - start))
+    for name, nrecords, updated_rows, elapsed in summary:
+        print("%s: %s records read in %0.1f s (dry run)" % (name, nrecords, elapsed))
+    return summary
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Import field form workbooks listed in a YAML manifest')
+    parser.add_argument('manifest', help='YAML file with the list of imports')
+    parser.add_argument('--dry-run', action='store_true', help='read the workbooks and summarise the records without connecting to the database')
+    parser.add_argument('--only', nargs='+', help='names of the imports to run')
+    parser.add_argument('--page-size', type=int, default=500, help='number of rows per INSERT statement')
+    args = parser.parse_args(argv)
+    run_manifest(args.manifest, execute=not args.dry_run, only=args.only, page_size=args.page_size)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
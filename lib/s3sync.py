@@ -0,0 +1,129 @@
+import hashlib
+import os
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from pathlib import Path
+
+# Default size of the parts for multipart transfers, this is also the part size used to compute the ETag of local files
+chunk_size = 8 * 1024 * 1024
+
+# Start a connection to S3 using the connection parameters from `read_s3params`
+def s3_client(s3params):
+    import boto3
+    return boto3.client('s3',
+                        s3params['region'],
+                        aws_access_key_id=s3params['key'],
+                        aws_secret_access_key=s3params['secret'])
+
+def transfer_config(max_concurrency=4):
+    from boto3.s3.transfer import TransferConfig
+    return TransferConfig(multipart_threshold=chunk_size, multipart_chunksize=chunk_size,
+                          max_concurrency=max_concurrency)
+
+## List all objects in a bucket, following the pagination of the listing
+# Returns a dictionary with the size and ETag of each object key
+def list_bucket(s3, bucket, prefix=''):
+    objects = dict()
+    paginator = s3.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+        for obj in page.get('Contents', []):
+            objects[obj['Key']] = {'size': obj['Size'], 'etag': obj['ETag'].strip('"')}
+    return objects
+
+## Compute the ETag that S3 would give to a local file
+# Files uploaded in one part have the MD5 of their content as ETag, whatever their size. Files uploaded in several parts (`multipart=True`) have the MD5 of the concatenated MD5 of each part of `part_size` bytes, followed by the number of parts.
+def local_etag(filename, multipart=False, part_size=chunk_size):
+    whole = hashlib.md5()
+    digests = list()
+    with open(filename, 'rb') as f:
+        for part in iter(lambda: f.read(part_size), b''):
+            if multipart:
+                digests.append(hashlib.md5(part))
+            else:
+                whole.update(part)
+    if not multipart or len(digests) == 0:
+        return whole.hexdigest()
+    combined = hashlib.md5(b''.join(d.digest() for d in digests))
+    return '%s-%s' % (combined.hexdigest(), len(digests))
+
+# Part size of a multipart upload with `nparts` parts, the default part size if it gives the same number of parts, otherwise the smallest whole number of MiB that does
+def _part_size(size, nparts):
+    if nparts <= 1 or -(-size // chunk_size) == nparts:
+        return chunk_size
+    mib = 1024 * 1024
+    return -(-size // (nparts * mib)) * mib
+
+# Check if a local file differs from the object in the bucket, comparing size first and then ETag. An ETag without `-` is the MD5 of the whole object.
+def file_changed(filename, remote):
+    if not os.path.isfile(filename):
+        return True
+    if os.path.getsize(filename) != remote['size']:
+        return True
+    etag = remote['etag']
+    if '-' not in etag:
+        return local_etag(filename) != etag
+    nparts = etag.rsplit('-', 1)[1]
+    part_size = _part_size(remote['size'], int(nparts)) if nparts.isdigit() else chunk_size
+    return local_etag(filename, multipart=True, part_size=part_size) != etag
+
+def _transfer(tasks, workers):
+    done = list()
+    failed = list()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(fn, *args): name for name, fn, args in tasks}
+        for future in as_completed(futures):
+            name = futures[future]
+            try:
+                future.result()
+                done.append(name)
+            except Exception as error:
+                print("transfer of %s failed: %s" % (name, error))
+                failed.append(name)
+    return done, failed
+
+## Download new or changed objects under `prefix` into `localdir`
+# Objects are compared with local files by size and ETag, only changed files are downloaded, using a pool of `workers` threads and multipart transfers for large files.
+def sync_download(s3, bucket, localdir, prefix='input-field-form/', workers=8, dry_run=False):
+    localdir = Path(localdir)
+    config = transfer_config()
+    tasks = list()
+    skipped = list()
+    for key, remote in list_bucket(s3, bucket, prefix).items():
+        relpath = key[len(prefix):]
+        if relpath == '' or key.endswith('/'):
+            continue
+        filename = localdir / relpath
+        if file_changed(filename, remote):
+            print("download file ", relpath)
+            filename.parent.mkdir(parents=True, exist_ok=True)
+            tasks.append((relpath, s3.download_file, (bucket, key, str(filename), None, None, config)))
+        else:
+            skipped.append(relpath)
+    print("%s files already present, %s files to download" % (len(skipped), len(tasks)))
+    if dry_run:
+        return {'transferred': [], 'failed': [], 'skipped': skipped, 'pending': [t[0] for t in tasks]}
+    done, failed = _transfer(tasks, workers)
+    return {'transferred': done, 'failed': failed, 'skipped': skipped}
+
+## Upload new or changed files from `localdir` matching `pattern` to `prefix` in the bucket
+# Temporary files created by Excel (names starting with `~`) are ignored.
+def sync_upload(s3, bucket, localdir, prefix='input-field-form/', pattern='*.xls[mx]', workers=8, dry_run=False):
+    localdir = Path(localdir)
+    config = transfer_config()
+    remote_objects = list_bucket(s3, bucket, prefix)
+    tasks = list()
+    skipped = list()
+    for filename in sorted(localdir.glob(pattern)):
+        targetname = filename.relative_to(localdir).as_posix()
+        if os.path.basename(targetname).startswith('~') or not filename.is_file():
+            continue
+        key = prefix + targetname
+        if key in remote_objects and not file_changed(filename, remote_objects[key]):
+            skipped.append(targetname)
+        else:
+            print("upload file ", targetname)
+            tasks.append((targetname, s3.upload_file, (str(filename), bucket, key, None, None, config)))
+    print("%s files already in bucket, %s files to upload" % (len(skipped), len(tasks)))
+    if dry_run:
+        return {'transferred': [], 'failed': [], 'skipped': skipped, 'pending': [t[0] for t in tasks]}
+    done, failed = _transfer(tasks, workers)
+    return {'transferred': done, 'failed': failed, 'skipped': skipped}
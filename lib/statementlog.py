@@ -0,0 +1,125 @@
+import hashlib
+import json
+import re
+import time
+from datetime import datetime
+from pathlib import Path
+
+## Optional log of database statements
+# When tracing is enabled with `enable_tracing`, statements run by `firevegdb.dbquery`, `batch_upsert`, `bulk_upsert` and `batch_update` are written to a local log (one JSON line per statement) with a fingerprint of the normalised SQL, the duration and the number of rows. For statements slower than `threshold` seconds the output of `EXPLAIN (ANALYZE, BUFFERS)` is captured as well. The statement is run again for the EXPLAIN, inside a savepoint that is rolled back, so inserts and updates are not applied twice. `statement_report` summarises the log with the top statements by total time.
+
+default_logfile = Path.home() / '.cache' / 'fireveg' / 'statements.jsonl'
+
+_config = None
+
+def enable_tracing(logfile=default_logfile, threshold=1.0, max_sql_length=2000):
+    global _config
+    logfile = Path(logfile)
+    logfile.parent.mkdir(parents=True, exist_ok=True)
+    _config = {'logfile': logfile, 'threshold': threshold, 'max_sql_length': max_sql_length}
+
+def disable_tracing():
+    global _config
+    _config = None
+
+def tracing_enabled():
+    return _config is not None
+
+re_string = re.compile(r"'(?:[^']|'')*'")
+re_number = re.compile(r"\b\d+(?:\.\d+)?\b")
+# values in a row after replacing literals: placeholders, NULL, booleans, arrays and point geometries, with an optional cast
+_element = r"(?:\?|NULL|TRUE|FALSE|ARRAY\[[^\]]*\]|ST_SetSRID\(ST_MakePoint\(\?,\s*\?\),\s*\?\))(?:::[\w ]+?(?=[,)]))?"
+_row = r"\(\s*%s(?:\s*,\s*%s)*\s*\)" % (_element, _element)
+re_values = re.compile(r"%s(?:\s*,\s*%s)+" % (_row, _row), re.IGNORECASE)
+re_inlist = re.compile(r"\(\s*\?(?:\s*,\s*\?)+\s*\)")
+re_space = re.compile(r"\s+")
+
+# Replace literals with placeholders and collapse multi-row VALUES and IN lists, so that the same statement with different values has the same fingerprint
+def normalise_sql(sql):
+    if isinstance(sql, bytes):
+        sql = sql.decode('utf-8', errors='replace')
+    sql = re_string.sub("?", sql)
+    sql = re_number.sub("?", sql)
+    sql = re_values.sub("(...),...", sql)
+    sql = re_inlist.sub("(...)", sql)
+    return re_space.sub(" ", sql).strip()
+
+def fingerprint(normalised):
+    return hashlib.md5(normalised.encode('utf-8')).hexdigest()[:12]
+
+def _explain(conn, sql):
+    cur = conn.cursor()
+    try:
+        if conn.autocommit:
+            # without a transaction the statement can not be rolled back, only the estimated plan is captured
+            cur.execute(b"EXPLAIN " + sql)
+            return [row[0] for row in cur.fetchall()]
+        cur.execute("SAVEPOINT statement_log_explain")
+        try:
+            cur.execute(b"EXPLAIN (ANALYZE, BUFFERS) " + sql)
+            return [row[0] for row in cur.fetchall()]
+        finally:
+            cur.execute("ROLLBACK TO SAVEPOINT statement_log_explain")
+    except Exception as error:
+        return ["EXPLAIN failed: %s" % str(error).strip()]
+    finally:
+        cur.close()
+
+def _write(entry):
+    with open(_config['logfile'], 'a') as f:
+        f.write(json.dumps(entry, default=str))
+        f.write('\n')
+
+## Execute a statement on a cursor, with tracing if it is enabled
+def traced_execute(cur, query, args=None):
+    if _config is None:
+        cur.execute(query, args)
+        return
+    sql = cur.mogrify(query, args) if args is not None else query
+    if isinstance(sql, str):
+        sql = sql.encode('utf-8')
+    start = time.perf_counter()
+    cur.execute(sql)
+    duration = time.perf_counter() - start
+    normalised = normalise_sql(sql)
+    entry = {'time': datetime.now().isoformat(timespec='seconds'),
+             'fingerprint': fingerprint(normalised),
+             'sql': normalised[:_config['max_sql_length']],
+             'duration': round(duration, 6),
+             'rows': cur.rowcount}
+    if duration >= _config['threshold'] and normalised.split(" ")[0].upper() in ('SELECT', 'WITH', 'INSERT', 'UPDATE', 'DELETE'):
+        entry['plan'] = _explain(cur.connection, sql)
+    _write(entry)
+
+## Summary of the statement log
+# Returns a list with calls, total, mean and maximum duration, total rows and the captured plans of the `n` statements with the highest total time
+def statement_report(logfile=default_logfile, n=10):
+    stats = dict()
+    with open(logfile) as f:
+        for line in f:
+            entry = json.loads(line)
+            item = stats.setdefault(entry['fingerprint'], {'fingerprint': entry['fingerprint'], 'sql': entry['sql'],
+                                                           'calls': 0, 'total': 0.0, 'max': 0.0, 'rows': 0, 'plans': 0,
+                                                           'slowest_plan': None})
+            item['calls'] = item['calls'] + 1
+            item['total'] = item['total'] + entry['duration']
+            item['rows'] = item['rows'] + max(entry['rows'], 0)
+            if 'plan' in entry:
+                item['plans'] = item['plans'] + 1
+            if entry['duration'] >= item['max']:
+                item['max'] = entry['duration']
+                if 'plan' in entry:
+                    item['slowest_plan'] = entry['plan']
+    report = sorted(stats.values(), key=lambda x: x['total'], reverse=True)[:n]
+    for item in report:
+        item['mean'] = item['total'] / item['calls']
+    return report
+
+def print_statement_report(logfile=default_logfile, n=10):
+    for item in statement_report(logfile, n):
+        print("%s  %8.3fs total  %6d calls  %8.4fs mean  %8.3fs max  %8d rows" % (
+            item['fingerprint'], item['total'], item['calls'], item['mean'], item['max'], item['rows']))
+        print("    %s" % item['sql'][:200])
+        if item['slowest_plan'] is not None:
+            for line in item['slowest_plan']:
+                print("      %s" % line)
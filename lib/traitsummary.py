@@ -0,0 +1,166 @@
+import time
+import psycopg2
+from psycopg2.extras import execute_values
+from psycopg2.extensions import AsIs
+from lib.firevegxport import summarise_values, summarise_triplet
+from lib.firevegcache import trait_info
+
+## Incremental species by trait summary
+# The summarised value, number of records and list of references of each (species_code, trait) pair are kept in `summary_table`. Writes to litrev tables with `batch_upsert` and `bulk_upsert`, and the species code updates in `firevegtaxa`, mark the affected pairs in `dirty_table` in the same transaction (by species code, or by species name for records without code). `refresh_summary` recomputes only the marked pairs, and `summary_matrix` returns the full matrix with one query.
+
+summary_table = 'litrev.species_trait_summary'
+dirty_table = 'litrev.species_trait_dirty'
+
+def create_summary_tables(cur):
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS %s (
+        species_code integer NOT NULL,
+        trait text NOT NULL,
+        value text,
+        nrecords integer,
+        refs text[],
+        updated_at timestamp DEFAULT now(),
+        PRIMARY KEY (species_code, trait));
+    CREATE TABLE IF NOT EXISTS %s (
+        trait text NOT NULL,
+        species_key text NOT NULL,
+        by_name boolean NOT NULL DEFAULT false,
+        marked_at timestamp DEFAULT now(),
+        PRIMARY KEY (trait, species_key, by_name));
+    """ % (summary_table, dirty_table))
+
+def _trait_name(table):
+    return table.split('.')[-1]
+
+## Mark the (species, trait) pairs of written records as dirty
+# Called by the upsert functions of `firevegdb` before they commit, records without species or species code (e.g. references) are ignored.
+def mark_dirty(cur, table, records):
+    keys = set()
+    for record in records:
+        code = record.get('species_code')
+        if code is not None:
+            keys.add((str(code), False))
+        elif record.get('species') is not None:
+            keys.add((record['species'], True))
+    if len(keys) == 0:
+        return 0
+    create_summary_tables(cur)
+    trait = _trait_name(table)
+    execute_values(cur, "INSERT INTO " + dirty_table + " (trait, species_key, by_name) VALUES %s ON CONFLICT DO NOTHING",
+                   [(trait, key, by_name) for key, by_name in keys])
+    return len(keys)
+
+def mark_dirty_names(cur, table, names):
+    return mark_dirty(cur, table, [{'species': name} for name in names])
+
+def _dirty_codes(cur, trait, table, keys):
+    codes = set()
+    names = list()
+    for key, by_name in keys:
+        if by_name:
+            names.append(key)
+        elif key.isnumeric():
+            codes.add(int(key))
+    if len(names) > 0:
+        cur.execute("SELECT DISTINCT species_code FROM %s WHERE species = ANY(%s) AND species_code IS NOT NULL",
+                    (AsIs(table), names))
+        codes.update(row[0] for row in cur.fetchall())
+    return codes
+
+def _summarise(value_type, rows):
+    refs = set()
+    for row in rows:
+        if row['main_source'] is not None:
+            refs.add(row['main_source'])
+        refs.update(row['original_sources'] or [])
+    if value_type == 'numerical':
+        value = summarise_triplet([r['best'] for r in rows], [r['lower'] for r in rows],
+                                  [r['upper'] for r in rows], [r['weight'] for r in rows])
+    else:
+        value = summarise_values([r['norm_value'] for r in rows], [r['weight'] for r in rows])
+    return value, len(rows), sorted(refs)
+
+def summarise_trait(cur, trait, value_type, codes=None):
+    table = 'litrev.%s' % trait
+    if value_type == 'numerical':
+        cols = "best::float8 AS best, lower::float8 AS lower, upper::float8 AS upper"
+    else:
+        cols = "norm_value::text AS norm_value"
+    qry = "SELECT species_code, %s, coalesce(weight, 1)::float8 AS weight, main_source, original_sources FROM %s WHERE species_code IS NOT NULL"
+    if codes is None:
+        cur.execute(qry, (AsIs(cols), AsIs(table)))
+    else:
+        cur.execute(qry + " AND species_code = ANY(%s)", (AsIs(cols), AsIs(table), list(codes)))
+    names = [col[0] for col in cur.description]
+    groups = dict()
+    for row in cur.fetchall():
+        row = dict(zip(names, row))
+        groups.setdefault(row['species_code'], list()).append(row)
+    return {code: _summarise(value_type, rows) for code, rows in groups.items()}
+
+## Recompute the summary of dirty pairs
+# With `full=True` all pairs of the selected `traits` (default all traits in litrev.trait_info) are recomputed. Dirty marks are removed in the same transaction as the new summary values are written. Returns the number of pairs recomputed for each trait.
+def refresh_summary(params, traits=None, full=False, useconn=None):
+    if useconn is None:
+        # connect to the PostgreSQL server
+        print('Connecting to the PostgreSQL database...')
+        conn = psycopg2.connect(**params)
+    else:
+        conn = useconn
+    cur = conn.cursor()
+    create_summary_tables(cur)
+    conn.commit()
+    info = trait_info(params, useconn=conn)
+    if traits is None:
+        traits = sorted(info.keys())
+    report = dict()
+    for trait in traits:
+        start = time.perf_counter()
+        table = 'litrev.%s' % trait
+        cur.execute("DELETE FROM " + dirty_table + " WHERE trait=%s RETURNING species_key, by_name", (trait,))
+        keys = cur.fetchall()
+        if full:
+            codes = None
+        elif len(keys) == 0:
+            conn.commit()
+            continue
+        else:
+            codes = _dirty_codes(cur, trait, table, keys)
+        summary = summarise_trait(cur, trait, info[trait]['value_type'], codes)
+        if codes is None:
+            cur.execute("DELETE FROM " + summary_table + " WHERE trait=%s", (trait,))
+        else:
+            # pairs without records left are removed
+            cur.execute("DELETE FROM " + summary_table + " WHERE trait=%s AND species_code = ANY(%s)",
+                        (trait, [code for code in codes if code not in summary]))
+        if len(summary) > 0:
+            execute_values(cur, "INSERT INTO " + summary_table + " (species_code, trait, value, nrecords, refs) VALUES %s " +
+                           "ON CONFLICT (species_code, trait) DO UPDATE SET value=EXCLUDED.value, nrecords=EXCLUDED.nrecords, refs=EXCLUDED.refs, updated_at=now()",
+                           [(code, trait) + values for code, values in summary.items()])
+        conn.commit()
+        report[trait] = len(summary) if codes is None else len(codes)
+        print("%s: %s species updated in %0.1f s" % (trait, report[trait], time.perf_counter() - start))
+    cur.close()
+    if useconn is None and conn is not None:
+        conn.close()
+        print('Database connection closed.')
+    return report
+
+## Species by trait matrix
+# Returns a data frame with one row per species code and one column per trait, from the summary table. With `filename` the matrix is also written as a CSV file (compressed if the name ends in .gz).
+def summary_matrix(params, filename=None, useconn=None):
+    import pandas as pd
+    if useconn is None:
+        conn = psycopg2.connect(**params)
+    else:
+        conn = useconn
+    cur = conn.cursor()
+    cur.execute("SELECT species_code, trait, value FROM " + summary_table)
+    df = pd.DataFrame(cur.fetchall(), columns=['species_code', 'trait', 'value'])
+    cur.close()
+    if useconn is None and conn is not None:
+        conn.close()
+    matrix = df.pivot(index='species_code', columns='trait', values='value').sort_index()
+    if filename is not None:
+        matrix.to_csv(filename)
+    return matrix
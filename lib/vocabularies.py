@@ -0,0 +1,99 @@
+import functools
+from collections import Counter
+from pathlib import Path
+
+## Normalisation of raw values to database vocabularies
+# Mappings of raw values to normalised values are read from `vocabulary-mappings.yml` (next to `trait-definitions.yml`) and compiled into lookup tables. Lookups try the raw value first and then a folded version (lower case, with whitespace collapsed), so that variants such as "Lignotuber", "lignotuber " or "LIGNOTUBER" map to the same value. Whole columns are normalised with one lookup per distinct value, and values without a mapping are counted in bulk.
+
+default_mappings_file = Path(__file__).resolve().parents[1] / 'vocabulary-mappings.yml'
+
+def fold(value):
+    if not isinstance(value, str):
+        return value
+    return " ".join(value.split()).casefold()
+
+class Vocabulary:
+    def __init__(self, mapping):
+        self.mapping = dict(mapping)
+        self.folded = dict()
+        for raw, norm in self.mapping.items():
+            self.folded.setdefault(fold(raw), norm)
+
+    # A vocabulary where each label maps to itself, e.g. for the enum types in the database
+    @classmethod
+    def from_labels(cls, labels):
+        return cls((label, label) for label in labels)
+
+    def __contains__(self, value):
+        return value in self.mapping or fold(value) in self.folded
+
+    def __len__(self):
+        return len(self.mapping)
+
+    # Same behaviour as `dict.get`, so vocabularies can be used where a switcher dictionary is expected
+    def get(self, value, default=None):
+        try:
+            if value in self.mapping:
+                return self.mapping[value]
+            return self.folded.get(fold(value), default)
+        except TypeError:
+            # unhashable values are never mapped
+            return default
+
+    def values(self):
+        return frozenset(v for v in self.mapping.values() if v is not None)
+
+    ## Normalise a whole column of values
+    # `values` is a list or a pandas Series. Returns the list of normalised values (or a Series with the same index) and a Counter with the values that are not in the vocabulary.
+    def normalise(self, values, default=None):
+        table = dict()
+        unmapped = Counter()
+        for value, count in Counter(values).items():
+            if value is None or value in self:
+                table[value] = self.get(value, default)
+            else:
+                table[value] = default
+                unmapped[value] = count
+        if hasattr(values, 'map'):
+            return values.map(table.__getitem__), unmapped
+        return [table[value] for value in values], unmapped
+
+    def unmapped(self, values):
+        return self.normalise(values)[1]
+
+@functools.lru_cache(maxsize=None)
+def _compiled_vocabulary(labels):
+    return Vocabulary.from_labels(sorted(labels, key=str))
+
+# Accept a Vocabulary, a dictionary or a list/set of valid labels, and return a compiled Vocabulary
+# Compiled vocabularies for lists of labels are memoised by their set of labels, so the conversion is done once per vocabulary and not once per record. Pass a frozenset (or compile the vocabulary once) when the same labels are used for many records.
+def as_vocabulary(vocab):
+    if isinstance(vocab, Vocabulary):
+        return vocab
+    if isinstance(vocab, dict):
+        return Vocabulary(vocab)
+    if not isinstance(vocab, frozenset):
+        vocab = frozenset(vocab)
+    return _compiled_vocabulary(vocab)
+
+@functools.lru_cache(maxsize=None)
+def read_mappings(mappings_file=default_mappings_file):
+    import yaml
+    with open(mappings_file) as f:
+        return yaml.safe_load(f)
+
+## Compiled vocabularies for one section of the mappings file
+# For the `nswffrd` section returns a dictionary with one Vocabulary per trait, for the `vegetation` section one Vocabulary per column.
+@functools.lru_cache(maxsize=None)
+def vocabularies(section, mappings_file=default_mappings_file):
+    mappings = read_mappings(mappings_file)[section]
+    return {name: Vocabulary(mapping) for name, mapping in mappings.items() if isinstance(mapping, dict)}
+
+## Definitions of the AusTraits import
+# Returns the dictionary used by `austraits_util.import_austraits`, with the `matched_values` of each AusTraits trait compiled as a Vocabulary
+def austraits_definitions(mappings_file=default_mappings_file):
+    definitions = dict()
+    for trait, austvals in read_mappings(mappings_file)['austraits'].items():
+        definitions[trait] = [{'austrait_name': vals['austrait_name'],
+                               'matched_values': Vocabulary(vals['matched_values'])} for vals in austvals]
+    return definitions